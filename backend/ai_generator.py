@@ -1,10 +1,112 @@
-from typing import Any, Dict, List, Optional
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Generator, List, Optional, Tuple
 
 import anthropic
+import numpy as np
+from models import SourceLink
 
 # Maximum number of tool execution rounds per query
 MAX_TOOL_ROUNDS = 2
 
+# Maximum number of exact-match responses kept in the LRU response cache
+RESPONSE_CACHE_SIZE = 512
+
+# Seconds to wait between Message Batches API status checks
+BATCH_POLL_INTERVAL = 30
+
+# Maximum number of entries kept in the semantic response cache
+SEMANTIC_CACHE_SIZE = 1024
+
+# Minimum cosine similarity for a cached response to answer a new query
+SEMANTIC_CACHE_THRESHOLD = 0.95
+
+# Minimum answer length that lets greedy_return skip a redundant tool round
+GREEDY_RETURN_MIN_CHARS = 200
+
+
+class SemanticResponseCache:
+    """Reuses responses for near-duplicate queries asked in the same context"""
+
+    def __init__(
+        self,
+        embedding_function,
+        max_size: int = SEMANTIC_CACHE_SIZE,
+        threshold: float = SEMANTIC_CACHE_THRESHOLD,
+    ):
+        self.embedding_function = embedding_function
+        self.max_size = max_size
+        self.threshold = threshold
+
+        # Preallocated on first store once the embedding width is known:
+        # normalized query embeddings, one row per entry, with parallel arrays
+        # of context ids and last-use ticks (for LRU eviction)
+        self._embeddings: Optional[np.ndarray] = None
+        self._context_ids: Optional[np.ndarray] = None
+        self._last_used: Optional[np.ndarray] = None
+        self._responses: List[Optional[str]] = [None] * max_size
+        self._size = 0
+        self._clock = 0
+        # Queries run in worker threads, so slot and LRU updates are guarded
+        self._lock = threading.Lock()
+
+    def embed(self, query: str) -> np.ndarray:
+        """Embed a query as a normalized float32 vector"""
+        vector = np.asarray(self.embedding_function([query])[0], dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    @staticmethod
+    def _context_id(context_hash: str) -> int:
+        """Reduce a context hash to a 64-bit id that NumPy can compare in bulk"""
+        digest = hashlib.blake2b(context_hash.encode("utf-8"), digest_size=8)
+        return int.from_bytes(digest.digest(), "little")
+
+    def lookup(self, query_vector: np.ndarray, context_hash: str) -> Optional[str]:
+        """Return the most similar cached response if it shares the same context"""
+        context_id = self._context_id(context_hash)
+        with self._lock:
+            if not self._size:
+                return None
+
+            # Score every cached query with one matrix-vector product, masking
+            # out entries from other conversation contexts so they can never win
+            n = self._size
+            scores = self._embeddings[:n] @ query_vector
+            scores[self._context_ids[:n] != context_id] = -np.inf
+            best = int(np.argmax(scores))
+            if scores[best] < self.threshold:
+                return None
+
+            self._clock += 1
+            self._last_used[best] = self._clock
+            return self._responses[best]
+
+    def store(self, query_vector: np.ndarray, context_hash: str, response: str):
+        """Add a response, evicting the least recently used entry if full"""
+        context_id = self._context_id(context_hash)
+        with self._lock:
+            if self._embeddings is None:
+                dim = query_vector.shape[0]
+                self._embeddings = np.zeros((self.max_size, dim), dtype=np.float32)
+                self._context_ids = np.zeros(self.max_size, dtype=np.uint64)
+                self._last_used = np.zeros(self.max_size, dtype=np.int64)
+
+            if self._size < self.max_size:
+                slot = self._size
+                self._size += 1
+            else:
+                slot = int(np.argmin(self._last_used))
+
+            self._clock += 1
+            self._embeddings[slot] = query_vector
+            self._context_ids[slot] = context_id
+            self._last_used[slot] = self._clock
+            self._responses[slot] = response
+
 
 class AIGenerator:
     """Handles interactions with Anthropic's Claude API for generating responses"""
@@ -46,162 +148,436 @@ All responses must be:
 Provide only the direct answer to what was asked.
 """
 
-    def __init__(self, api_key: str, model: str):
+    # System prompt block marked for Anthropic prompt caching
+    SYSTEM_BLOCK = {
+        "type": "text",
+        "text": SYSTEM_PROMPT,
+        "cache_control": {"type": "ephemeral"},
+    }
+
+    # Shared, byte-identical system content for every call; never mutated
+    STATIC_SYSTEM_CONTENT = [SYSTEM_BLOCK]
+
+    # Idempotent read-only tools that greedy_return may skip
+    GREEDY_SKIPPABLE_TOOLS = frozenset({"search_course_content"})
+
+    def __init__(
+        self,
+        api_key: str,
+        model: str,
+        embedding_function=None,
+        router_model: Optional[str] = None,
+        greedy_return: bool = False,
+    ):
         self.client = anthropic.Anthropic(api_key=api_key)
         self.model = model
+        # Cheaper model for the first call of a query, which decides whether to
+        # use tools; every call after tool results goes to the main model
+        self.router_model = router_model or model
+        # Return an answer the model already wrote instead of running the
+        # confirmatory searches it requested alongside it
+        self.greedy_return = greedy_return
 
         # Pre-build base API parameters
         self.base_params = {"model": self.model, "temperature": 0, "max_tokens": 800}
 
+        # Exact-match LRU cache of final response text keyed by prompt hash
+        self._response_cache: "OrderedDict[str, str]" = OrderedDict()
+        # Queries run in worker threads; get/move_to_end/popitem must not interleave
+        self._cache_lock = threading.Lock()
+
+        # Optional similarity cache for paraphrased queries
+        self.semantic_cache = (
+            SemanticResponseCache(embedding_function) if embedding_function else None
+        )
+
     def generate_response(
         self,
         query: str,
-        conversation_history: Optional[str] = None,
+        conversation_history: Optional[List[Dict[str, str]]] = None,
         tools: Optional[List] = None,
         tool_manager=None,
-    ) -> str:
+        user_query: Optional[str] = None,
+    ) -> Tuple[str, List[SourceLink]]:
         """
         Generate AI response with optional tool usage and conversation context.
         Supports up to MAX_TOOL_ROUNDS of sequential tool calling.
 
         Args:
             query: The user's question or request
-            conversation_history: Previous messages for context
+            conversation_history: Previous turns as role/content messages
             tools: Available tools the AI can use
             tool_manager: Manager to execute tools
+            user_query: The user's own words when query wraps them in a prompt;
+                the semantic cache embeds this so a shared prefix cannot make
+                different questions look alike (defaults to query)
 
         Returns:
-            Generated response as string
+            Tuple of (generated response, sources of the last tool call that
+            returned any, empty when no tool produced sources)
         """
 
-        # Build system content efficiently - avoid string ops when possible
-        system_content = (
-            f"{self.SYSTEM_PROMPT}\n\nPrevious conversation:\n{conversation_history}"
-            if conversation_history
-            else self.SYSTEM_PROMPT
+        # Serve identical or near-duplicate prompts without an API call
+        cache_key = self._response_cache_key(query, conversation_history, tools)
+        context_hash = self._response_cache_key("", conversation_history, tools)
+        cached, query_vector = self._lookup_cached_response(
+            user_query or query, cache_key, context_hash
         )
+        if cached is not None:
+            return cached, []
 
-        # Initialize message history
-        messages = [{"role": "user", "content": query}]
-
-        # Prepare initial API call parameters
-        api_params = {
-            **self.base_params,
-            "messages": messages,
-            "system": system_content,
-        }
-
-        # Add tools if available
-        if tools:
-            api_params["tools"] = tools
-            api_params["tool_choice"] = {"type": "auto"}
+        api_params = self._build_api_params(query, conversation_history, tools)
 
         # Get initial response from Claude
         response = self.client.messages.create(**api_params)
 
         # Handle sequential tool execution
+        sources: List[SourceLink] = []
         tool_round = 0
         while (
             response.stop_reason == "tool_use"
             and tool_round < MAX_TOOL_ROUNDS
             and tool_manager
         ):
+            # The model already answered; skip the redundant search round
+            greedy_text = self._greedy_text(response)
+            if greedy_text is not None:
+                return greedy_text, sources
+
             tool_round += 1
 
             # Execute tools and update messages
-            messages = self._execute_tools_and_build_messages(
-                response, messages, tool_manager
+            messages, round_sources = self._execute_tools_and_build_messages(
+                response, api_params["messages"], tool_manager
             )
 
-            # Check if this is the final round
-            is_final_round = tool_round >= MAX_TOOL_ROUNDS
+            # Malformed tool_use response with no tool calls: answer with
+            # whatever text it carried instead of paying for another call
+            if messages is None:
+                return self._extract_text(response), sources
+            sources = round_sources or sources
+            self._prepare_next_round(api_params, messages, tool_round)
 
-            # Prepare next API call
-            next_params = {
-                **self.base_params,
-                "messages": messages,
-                "system": system_content,
-            }
+            # Get next response
+            response = self.client.messages.create(**api_params)
 
-            # Only include tools if not the final round
-            if not is_final_round and tools:
-                next_params["tools"] = tools
-                next_params["tool_choice"] = {"type": "auto"}
+        text = self._extract_text(response)
 
-            # Get next response
-            response = self.client.messages.create(**next_params)
+        # Only cache answers that did not depend on tool execution, since
+        # tool calls also populate the sources shown alongside the answer
+        if tool_round == 0 and response.stop_reason != "tool_use":
+            self._cache_response(cache_key, context_hash, query_vector, text)
 
         # Return final text response
-        return response.content[0].text
+        return text, sources
 
-    def _execute_tools_and_build_messages(
-        self, response, messages: List[Dict[str, Any]], tool_manager
-    ) -> List[Dict[str, Any]]:
+    def generate_response_stream(
+        self,
+        query: str,
+        conversation_history: Optional[List[Dict[str, str]]] = None,
+        tools: Optional[List] = None,
+        tool_manager=None,
+        user_query: Optional[str] = None,
+    ) -> Generator[str, None, List[SourceLink]]:
         """
-        Execute tools from a response and build updated message list.
+        Stream an AI response as text deltas while it is being generated.
+        Follows the same tool-calling and caching rules as generate_response.
+
+        Only the final round's text is yielded, so preambles the model writes
+        before a tool call never reach the caller. A call with tools may still
+        end in a tool round, so its text is held until the round ends; only
+        the forced final round, which has no tools, streams as it arrives.
 
         Args:
-            response: The API response containing tool use requests
-            messages: Current message history
+            query: The user's question or request
+            conversation_history: Previous turns as role/content messages
+            tools: Available tools the AI can use
             tool_manager: Manager to execute tools
+            user_query: The user's own words, embedded for the semantic cache
+                (defaults to query)
+
+        Yields:
+            Chunks of the final response text in generation order
 
         Returns:
-            Updated messages list with assistant tool use and user tool results
+            Sources of the last tool call that returned any, as the value of
+            the generator's StopIteration
         """
-        # Add AI's tool use response
-        messages.append({"role": "assistant", "content": response.content})
+        cache_key = self._response_cache_key(query, conversation_history, tools)
+        context_hash = self._response_cache_key("", conversation_history, tools)
+        cached, query_vector = self._lookup_cached_response(
+            user_query or query, cache_key, context_hash
+        )
+        if cached is not None:
+            yield cached
+            return []
 
-        # Execute all tool calls and collect results
-        tool_results = []
-        for content_block in response.content:
-            if content_block.type == "tool_use":
-                tool_result = tool_manager.execute_tool(
-                    content_block.name, **content_block.input
-                )
-
-                tool_results.append(
-                    {
-                        "type": "tool_result",
-                        "tool_use_id": content_block.id,
-                        "content": tool_result,
-                    }
-                )
+        api_params = self._build_api_params(query, conversation_history, tools)
 
-        # Add tool results as single message
-        if tool_results:
-            messages.append({"role": "user", "content": tool_results})
+        sources: List[SourceLink] = []
+        tool_round = 0
+        while True:
+            # Without tools this round must be the answer, so forward it live
+            live = "tools" not in api_params
+            chunks = []
+            with self.client.messages.stream(**api_params) as stream:
+                for text in stream.text_stream:
+                    chunks.append(text)
+                    if live:
+                        yield text
+                response = stream.get_final_message()
+
+            if not (
+                response.stop_reason == "tool_use"
+                and tool_round < MAX_TOOL_ROUNDS
+                and tool_manager
+            ):
+                break
+            if self._greedy_text(response) is not None:
+                break
+
+            tool_round += 1
+            messages, round_sources = self._execute_tools_and_build_messages(
+                response, api_params["messages"], tool_manager
+            )
+            if messages is None:
+                break
+            sources = round_sources or sources
+            self._prepare_next_round(api_params, messages, tool_round)
+
+        # The held text belongs to the final round, so it is the answer
+        if not live:
+            yield from chunks
+
+        if tool_round == 0 and response.stop_reason != "tool_use":
+            self._cache_response(cache_key, context_hash, query_vector, "".join(chunks))
+        return sources
+
+    def generate_batch(
+        self, queries: List[str], poll_interval: float = BATCH_POLL_INTERVAL
+    ) -> Dict[str, Optional[str]]:
+        """
+        Answer many independent queries through the Message Batches API.
 
-        return messages
+        Batches are billed at a discount but can take minutes to hours to
+        complete, so this is for offline work such as bulk Q&A or evaluations,
+        never for interactive requests. Tools are not offered because tool
+        calls cannot be executed mid-batch.
 
-    def _handle_tool_execution(
-        self, initial_response, base_params: Dict[str, Any], tool_manager
+        Args:
+            queries: Questions to answer, each without conversation history
+            poll_interval: Seconds to wait between batch status checks
+
+        Returns:
+            Dict mapping custom_id ("q-<index>") to response text, or None for
+            requests that did not succeed
+        """
+        requests = [
+            {
+                "custom_id": f"q-{i}",
+                "params": self._build_api_params(query, None, None),
+            }
+            for i, query in enumerate(queries)
+        ]
+        batch = self.client.messages.batches.create(requests=requests)
+
+        while batch.processing_status != "ended":
+            time.sleep(poll_interval)
+            batch = self.client.messages.batches.retrieve(batch.id)
+
+        responses: Dict[str, Optional[str]] = {
+            request["custom_id"]: None for request in requests
+        }
+        for entry in self.client.messages.batches.results(batch.id):
+            if entry.result.type == "succeeded":
+                responses[entry.custom_id] = self._extract_text(entry.result.message)
+        return responses
+
+    def _build_api_params(
+        self,
+        query: str,
+        conversation_history: Optional[List[Dict[str, str]]],
+        tools: Optional[List],
+    ) -> Dict[str, Any]:
+        """Build the parameters for the first API call of a query"""
+        # Previous turns go ahead of the query as messages so the system
+        # prompt stays an identical, cacheable prefix on every call
+        api_params = {
+            **self.base_params,
+            "messages": [
+                *(conversation_history or []),
+                {"role": "user", "content": query},
+            ],
+            "system": self.STATIC_SYSTEM_CONTENT,
+        }
+
+        # Add tools if available, marking their definitions as cacheable too
+        if tools:
+            api_params["model"] = self.router_model
+            api_params["tools"] = self._with_cache_control(tools)
+            api_params["tool_choice"] = {"type": "auto"}
+
+        return api_params
+
+    def _prepare_next_round(
+        self,
+        api_params: Dict[str, Any],
+        messages: List[Dict[str, Any]],
+        tool_round: int,
     ):
+        """Update parameters in place for the API call after a tool round"""
+        # Reuse the same parameters; only the messages change between rounds.
+        # Any call that reads tool results may write the answer, so it always
+        # goes to the main model
+        api_params["messages"] = messages
+        api_params["model"] = self.model
+
+        # Drop tools on the final round to force a synthesized answer
+        if tool_round >= MAX_TOOL_ROUNDS:
+            api_params.pop("tools", None)
+            api_params.pop("tool_choice", None)
+
+    def _lookup_cached_response(
+        self, query: str, cache_key: str, context_hash: str
+    ) -> Tuple[Optional[str], Optional[np.ndarray]]:
+        """
+        Check the exact-match cache, then the semantic cache.
+
+        Returns:
+            Tuple of (cached text or None, query embedding if one was computed)
+        """
+        with self._cache_lock:
+            cached = self._response_cache.get(cache_key)
+            if cached is not None:
+                self._response_cache.move_to_end(cache_key)
+                return cached, None
+
+        # Fall back to near-duplicate queries asked in the same context
+        if not self.semantic_cache:
+            return None, None
+        query_vector = self.semantic_cache.embed(query)
+        return self.semantic_cache.lookup(query_vector, context_hash), query_vector
+
+    def _cache_response(
+        self,
+        cache_key: str,
+        context_hash: str,
+        query_vector: Optional[np.ndarray],
+        text: str,
+    ):
+        """Record a final response in the exact-match and semantic caches"""
+        # An empty answer is never worth replaying
+        if not text:
+            return
+        self._store_cached_response(cache_key, text)
+        if self.semantic_cache:
+            self.semantic_cache.store(query_vector, context_hash, text)
+
+    @staticmethod
+    def _extract_text(response) -> str:
+        """Return the first non-tool content block's text, or an empty string"""
+        for block in response.content:
+            if block.type != "tool_use":
+                return block.text
+        return ""
+
+    def _greedy_text(self, response) -> Optional[str]:
+        """
+        Return the text of a tool_use response that already holds an answer.
+
+        Only applies when greedy_return is enabled, the text is at least
+        GREEDY_RETURN_MIN_CHARS long and every requested tool is a read-only
+        search whose result could not change that answer.
+        """
+        if not self.greedy_return:
+            return None
+
+        text_parts = []
+        for block in response.content:
+            if block.type == "tool_use":
+                if block.name not in self.GREEDY_SKIPPABLE_TOOLS:
+                    return None
+            elif block.type == "text":
+                text_parts.append(block.text)
+
+        text = "".join(text_parts)
+        return text if len(text) >= GREEDY_RETURN_MIN_CHARS else None
+
+    @staticmethod
+    def _with_cache_control(tools: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Copy tool definitions with a cache breakpoint on the last one"""
+        return [*tools[:-1], {**tools[-1], "cache_control": {"type": "ephemeral"}}]
+
+    def _response_cache_key(
+        self,
+        query: str,
+        conversation_history: Optional[List[Dict[str, str]]],
+        tools: Optional[List],
+    ) -> str:
+        """Build a stable hash of everything that determines the response"""
+        tool_names = ",".join(sorted(tool["name"] for tool in tools or []))
+        history = "\n".join(
+            f"{message['role']}: {message['content']}"
+            for message in conversation_history or []
+        )
+        key_parts = [self.model, query, history, tool_names]
+        return hashlib.blake2b("\0".join(key_parts).encode("utf-8")).hexdigest()
+
+    def _store_cached_response(self, cache_key: str, text: str):
+        """Store a response, evicting the least recently used entry if full"""
+        with self._cache_lock:
+            self._response_cache[cache_key] = text
+            self._response_cache.move_to_end(cache_key)
+            if len(self._response_cache) > RESPONSE_CACHE_SIZE:
+                self._response_cache.popitem(last=False)
+
+    def _execute_tools_and_build_messages(
+        self, response, messages: List[Dict[str, Any]], tool_manager
+    ) -> Tuple[Optional[List[Dict[str, Any]]], List[SourceLink]]:
         """
-        Handle execution of tool calls and get follow-up response.
+        Execute tools from a response and build updated message list.
 
         Args:
-            initial_response: The response containing tool use requests
-            base_params: Base API parameters
+            response: The API response containing tool use requests
+            messages: Current message history
             tool_manager: Manager to execute tools
 
         Returns:
-            Final response text after tool execution
+            Tuple of (updated messages list with assistant tool use and user
+            tool results, or None if the response contained no tool_use
+            blocks; sources of the last tool call that returned any)
         """
-        # Start with existing messages
-        messages = base_params["messages"].copy()
+        tool_blocks = [block for block in response.content if block.type == "tool_use"]
 
-        # Execute tools and build messages
-        messages = self._execute_tools_and_build_messages(
-            initial_response, messages, tool_manager
-        )
+        # Nothing to execute, so another API round trip would be wasted
+        if not tool_blocks:
+            return None, []
 
-        # Prepare final API call without tools
-        final_params = {
-            **self.base_params,
-            "messages": messages,
-            "system": base_params["system"],
-        }
+        # Add AI's tool use response
+        messages.append({"role": "assistant", "content": response.content})
+
+        def run_tool(block) -> Tuple[str, List[SourceLink]]:
+            return tool_manager.execute_tool(block.name, **block.input)
+
+        # Independent tool calls are I/O-bound, so run them concurrently when
+        # there is more than one. Each call returns its own sources, and map()
+        # keeps outputs in tool_use order, so the result is deterministic
+        if len(tool_blocks) > 1:
+            with ThreadPoolExecutor(max_workers=len(tool_blocks)) as executor:
+                outputs = list(executor.map(run_tool, tool_blocks))
+        else:
+            outputs = [run_tool(block) for block in tool_blocks]
+
+        tool_results = []
+        sources: List[SourceLink] = []
+        for block, (output, call_sources) in zip(tool_blocks, outputs):
+            tool_results.append(
+                {"type": "tool_result", "tool_use_id": block.id, "content": output}
+            )
+            sources = call_sources or sources
+
+        # Add tool results as single message
+        if tool_results:
+            messages.append({"role": "user", "content": tool_results})
 
-        # Get final response
-        final_response = self.client.messages.create(**final_params)
-        return final_response.content[0].text
+        return messages, sources
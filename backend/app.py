@@ -2,6 +2,7 @@ import warnings
 
 warnings.filterwarnings("ignore", message="resource_tracker: There appear to be.*")
 
+import asyncio
 import os
 from typing import List, Optional
 
@@ -9,14 +10,20 @@ from config import config
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.middleware.trustedhost import TrustedHostMiddleware
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, ORJSONResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from models import SourceLink
 from pydantic import BaseModel
 from rag_system import RAGSystem
+from streaming import ndjson_events
 
 # Initialize FastAPI app
-app = FastAPI(title="Course Materials RAG System", root_path="")
+# orjson serializes responses directly, skipping the stdlib json encoder
+app = FastAPI(
+    title="Course Materials RAG System",
+    root_path="",
+    default_response_class=ORJSONResponse,
+)
 
 # Add trusted host middleware for proxy
 app.add_middleware(TrustedHostMiddleware, allowed_hosts=["*"])
@@ -70,22 +77,48 @@ async def query_documents(request: QueryRequest):
         if not session_id:
             session_id = rag_system.session_manager.create_session()
 
-        # Process query using RAG system
-        answer, sources = rag_system.query(request.query, session_id)
+        # Process query using RAG system; it blocks on the Anthropic API and
+        # vector search, so run it in a worker thread to keep the loop free
+        answer, sources = await asyncio.to_thread(
+            rag_system.query, request.query, session_id
+        )
 
-        return QueryResponse(answer=answer, sources=sources, session_id=session_id)
+        # Returning a Response directly skips FastAPI's jsonable_encoder pass
+        return ORJSONResponse(
+            QueryResponse(
+                answer=answer, sources=sources, session_id=session_id
+            ).model_dump()
+        )
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@app.post("/api/query/stream")
+async def query_documents_stream(request: QueryRequest):
+    """
+    Stream a query response as newline-delimited JSON events.
+
+    Emits {"type": "text", "text": ...} for each chunk of the answer, then a
+    final {"type": "done", "sources": [...], "session_id": ...} event.
+    """
+    session_id = request.session_id
+    if not session_id:
+        session_id = rag_system.session_manager.create_session()
+
+    events = ndjson_events(rag_system.query_stream, request.query, session_id)
+    return StreamingResponse(events, media_type="application/x-ndjson")
+
+
 @app.get("/api/courses", response_model=CourseStats)
 async def get_course_stats():
     """Get course analytics and statistics"""
     try:
-        analytics = rag_system.get_course_analytics()
-        return CourseStats(
-            total_courses=analytics["total_courses"],
-            course_titles=analytics["course_titles"],
+        analytics = await asyncio.to_thread(rag_system.get_course_analytics)
+        return ORJSONResponse(
+            CourseStats(
+                total_courses=analytics["total_courses"],
+                course_titles=analytics["course_titles"],
+            ).model_dump()
         )
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -14,6 +14,14 @@ class Config:
     # Anthropic API settings
     ANTHROPIC_API_KEY: str = os.getenv("ANTHROPIC_API_KEY", "")
     ANTHROPIC_MODEL: str = "claude-sonnet-4-20250514"
+    # Faster model for the first, tool-routing call of a query when the cascade
+    # is on; calls after tool results always use ANTHROPIC_MODEL. Off by
+    # default, since a query answered without tools is then written by it
+    ANTHROPIC_ROUTER_MODEL: str = "claude-haiku-4-5-20251001"
+    USE_MODEL_CASCADE: bool = False  # Set True to route first calls to it
+    # Return an answer the model already wrote alongside a redundant search
+    # request instead of running that search and asking again
+    GREEDY_RETURN: bool = False
 
     # Embedding model settings
     EMBEDDING_MODEL: str = "all-MiniLM-L6-v2"
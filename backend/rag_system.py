@@ -1,11 +1,12 @@
 import os
-from typing import Dict, List, Optional, Tuple
+from typing import Dict, Generator, List, Optional, Tuple
 
 from ai_generator import AIGenerator
 from document_processor import DocumentProcessor
-from models import Course
+from models import Course, SourceLink
 from search_tools import CourseOutlineTool, CourseSearchTool, ToolManager
 from session_manager import SessionManager
+from streaming import relay
 from vector_store import VectorStore
 
 
@@ -23,7 +24,13 @@ class RAGSystem:
             config.CHROMA_PATH, config.EMBEDDING_MODEL, config.MAX_RESULTS
         )
         self.ai_generator = AIGenerator(
-            config.ANTHROPIC_API_KEY, config.ANTHROPIC_MODEL
+            config.ANTHROPIC_API_KEY,
+            config.ANTHROPIC_MODEL,
+            embedding_function=self.vector_store.embedding_function,
+            router_model=(
+                config.ANTHROPIC_ROUTER_MODEL if config.USE_MODEL_CASCADE else None
+            ),
+            greedy_return=config.GREEDY_RETURN,
         )
         self.session_manager = SessionManager(config.MAX_HISTORY)
 
@@ -56,6 +63,9 @@ class RAGSystem:
             # Add course content chunks to vector store
             self.vector_store.add_course_content(course_chunks)
 
+            # Cached tool results may no longer reflect the indexed content
+            self.tool_manager.clear_cache()
+
             return course, len(course_chunks)
         except Exception as e:
             print(f"Error processing course document {file_path}: {e}")
@@ -117,6 +127,10 @@ class RAGSystem:
                 except Exception as e:
                     print(f"Error processing {file_name}: {e}")
 
+        # Cached tool results may no longer reflect the indexed content
+        if clear_existing or total_courses:
+            self.tool_manager.clear_cache()
+
         return total_courses, total_chunks
 
     def query(
@@ -140,27 +154,73 @@ class RAGSystem:
         if session_id:
             history = self.session_manager.get_conversation_history(session_id)
 
-        # Generate response using AI with tools
-        response = self.ai_generator.generate_response(
+        # Generate response using AI with tools; sources come back with it,
+        # so concurrent queries never share them
+        response, sources = self.ai_generator.generate_response(
             query=prompt,
             conversation_history=history,
             tools=self.tool_manager.get_tool_definitions(),
             tool_manager=self.tool_manager,
+            user_query=query,
         )
 
-        # Get sources from the search tool
-        sources = self.tool_manager.get_last_sources()
-
-        # Reset sources after retrieving them
-        self.tool_manager.reset_sources()
-
-        # Update conversation history
-        if session_id:
+        # Update conversation history; an empty assistant turn would make the
+        # API reject every later request in the session, so skip those
+        if session_id and response:
             self.session_manager.add_exchange(session_id, query, response)
 
         # Return response with sources from tool searches
         return response, sources
 
+    def query_stream(
+        self, query: str, session_id: Optional[str] = None
+    ) -> Generator[str, None, List[SourceLink]]:
+        """
+        Stream the answer to a user query as it is generated.
+
+        The exchange is added to the session history once the stream is
+        exhausted.
+
+        Args:
+            query: User's question
+            session_id: Optional session ID for conversation context
+
+        Yields:
+            Chunks of the response text
+
+        Returns:
+            Sources from the tool searches, as the value of the generator's
+            StopIteration
+        """
+        prompt = f"""Answer this question about course materials: {query}"""
+
+        history = None
+        if session_id:
+            history = self.session_manager.get_conversation_history(session_id)
+
+        stream = self.ai_generator.generate_response_stream(
+            query=prompt,
+            conversation_history=history,
+            tools=self.tool_manager.get_tool_definitions(),
+            tool_manager=self.tool_manager,
+            user_query=query,
+        )
+
+        # Forward chunks while recording them, keeping the returned sources
+        chunks = []
+
+        def record(chunk: str) -> str:
+            chunks.append(chunk)
+            return chunk
+
+        sources = yield from relay(stream, record)
+
+        answer = "".join(chunks)
+        if session_id and answer:
+            self.session_manager.add_exchange(session_id, query, answer)
+
+        return sources
+
     def get_course_analytics(self) -> Dict:
         """Get analytics about the course catalog"""
         return {
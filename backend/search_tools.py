@@ -1,13 +1,33 @@
+import threading
+import time
 from abc import ABC, abstractmethod
-from typing import Any, Dict, List, Optional
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
 
 from models import SourceLink
 from vector_store import SearchResults, VectorStore
 
+# Reply for an empty search with no course or lesson filter
+_NO_CONTENT_MESSAGE = "No relevant content found."
+
+# Most tool results ToolManager keeps before evicting the least recently used
+TOOL_CACHE_SIZE = 256
+
+
+def _source_sort_key(meta: Dict[str, Any]) -> Tuple[str, bool, int]:
+    """Order sources by course title, then lesson number; no lesson sorts last"""
+    lesson_num = meta.get("lesson_number")
+    return (meta.get("course_title", "unknown"), lesson_num is None, lesson_num or 0)
+
 
 class Tool(ABC):
     """Abstract base class for all tools"""
 
+    __slots__ = ()
+
+    # Seconds a result may be reused by ToolManager (0 = never cache)
+    cache_ttl: float = 0
+
     @abstractmethod
     def get_tool_definition(self) -> Dict[str, Any]:
         """Return Anthropic tool definition for this tool"""
@@ -18,40 +38,48 @@ class Tool(ABC):
         """Execute the tool with given parameters"""
         pass
 
+    def run(self, **kwargs) -> Tuple[str, List[SourceLink]]:
+        """Execute the tool, returning its result and the sources behind it"""
+        return self.execute(**kwargs), []
+
 
 class CourseSearchTool(Tool):
     """Tool for searching course content with semantic course name matching"""
 
+    __slots__ = ("store",)
+
+    cache_ttl = 60 * 60  # Search results only change when content is added
+
+    # Static, so every call returns this one dict; callers copy before changing it
+    _DEFINITION: Dict[str, Any] = {
+        "name": "search_course_content",
+        "description": "Search course materials with smart course name matching and lesson filtering",
+        "input_schema": {
+            "type": "object",
+            "properties": {
+                "query": {
+                    "type": "string",
+                    "description": "What to search for in the course content",
+                },
+                "course_name": {
+                    "type": "string",
+                    "description": "Course title (partial matches work, e.g. 'MCP', 'Introduction')",
+                },
+                "lesson_number": {
+                    "type": "integer",
+                    "description": "Specific lesson number to search within (e.g. 1, 2, 3)",
+                },
+            },
+            "required": ["query"],
+        },
+    }
+
     def __init__(self, vector_store: VectorStore):
         self.store = vector_store
-        self.last_sources = (
-            []
-        )  # Track sources from last search (list of SourceLink objects)
 
     def get_tool_definition(self) -> Dict[str, Any]:
         """Return Anthropic tool definition for this tool"""
-        return {
-            "name": "search_course_content",
-            "description": "Search course materials with smart course name matching and lesson filtering",
-            "input_schema": {
-                "type": "object",
-                "properties": {
-                    "query": {
-                        "type": "string",
-                        "description": "What to search for in the course content",
-                    },
-                    "course_name": {
-                        "type": "string",
-                        "description": "Course title (partial matches work, e.g. 'MCP', 'Introduction')",
-                    },
-                    "lesson_number": {
-                        "type": "integer",
-                        "description": "Specific lesson number to search within (e.g. 1, 2, 3)",
-                    },
-                },
-                "required": ["query"],
-            },
-        }
+        return self._DEFINITION
 
     def execute(
         self,
@@ -59,6 +87,15 @@ class CourseSearchTool(Tool):
         course_name: Optional[str] = None,
         lesson_number: Optional[int] = None,
     ) -> str:
+        """Execute the search tool, returning only the formatted results"""
+        return self.run(query, course_name, lesson_number)[0]
+
+    def run(
+        self,
+        query: str,
+        course_name: Optional[str] = None,
+        lesson_number: Optional[int] = None,
+    ) -> Tuple[str, List[SourceLink]]:
         """
         Execute the search tool with given parameters.
 
@@ -68,7 +105,8 @@ class CourseSearchTool(Tool):
             lesson_number: Optional lesson filter
 
         Returns:
-            Formatted search results or error message
+            Formatted search results or error message, and the sources of the
+            results (empty when nothing was found)
         """
 
         # Use the vector store's unified search interface
@@ -78,26 +116,41 @@ class CourseSearchTool(Tool):
 
         # Handle errors
         if results.error:
-            return results.error
+            return results.error, []
 
-        # Handle empty results
+        # Handle empty results; unfiltered searches share one constant message
         if results.is_empty():
+            if not course_name and not lesson_number:
+                return _NO_CONTENT_MESSAGE, []
             filter_info = ""
             if course_name:
                 filter_info += f" in course '{course_name}'"
             if lesson_number:
                 filter_info += f" in lesson {lesson_number}"
-            return f"No relevant content found{filter_info}."
+            return f"No relevant content found{filter_info}.", []
 
         # Format and return results
         return self._format_results(results)
 
-    def _format_results(self, results: SearchResults) -> str:
+    def _format_results(self, results: SearchResults) -> Tuple[str, List[SourceLink]]:
         """Format search results with course and lesson context"""
         formatted = []
-        sources_with_metadata = []  # Store (SourceLink, metadata) for sorting
+        # Parallel lists of sources and their (course, lesson) sort keys
+        source_links = []
+        sort_keys = []
+
+        # Fetch links for every distinct lesson in a single vector store call
+        lesson_pairs = list(
+            dict.fromkeys(
+                (meta.get("course_title", "unknown"), meta.get("lesson_number"))
+                for meta in results.metadata
+                if meta.get("lesson_number") is not None
+            )
+        )
+        lesson_links = (
+            self.store.get_lesson_links_batch(lesson_pairs) if lesson_pairs else {}
+        )
 
-        # First pass: collect all sources with their metadata
         for doc, meta in zip(results.documents, results.metadata):
             course_title = meta.get("course_title", "unknown")
             lesson_num = meta.get("lesson_number")
@@ -113,57 +166,49 @@ class CourseSearchTool(Tool):
             if lesson_num is not None:
                 source_text += f" - Lesson {lesson_num}"
 
-            # Get lesson link from vector store if lesson number exists
-            lesson_link = None
-            if lesson_num is not None:
-                lesson_link = self.store.get_lesson_link(course_title, lesson_num)
-
-            # Create SourceLink object and store with metadata
-            source_link = SourceLink(text=source_text, link=lesson_link)
-            sources_with_metadata.append(
-                (
-                    source_link,
-                    course_title,
-                    lesson_num if lesson_num is not None else float("inf"),
-                )
-            )
+            # Look up lesson link from the batched results
+            lesson_link = lesson_links.get((course_title, lesson_num))
+
+            # Create SourceLink object; sources without a lesson sort last
+            source_links.append(SourceLink(text=source_text, link=lesson_link))
+            sort_keys.append(_source_sort_key(meta))
 
             formatted.append(f"{header}\n{doc}")
 
         # Sort sources by course title, then by lesson number (ascending)
-        sources_with_metadata.sort(key=lambda x: (x[1], x[2]))
-
-        # Extract just the SourceLink objects after sorting
-        sorted_sources = [source for source, _, _ in sources_with_metadata]
-
-        # Store sorted sources for retrieval
-        self.last_sources = sorted_sources
+        order = sorted(range(len(sort_keys)), key=sort_keys.__getitem__)
 
-        return "\n\n".join(formatted)
+        return "\n\n".join(formatted), [source_links[i] for i in order]
 
 
 class CourseOutlineTool(Tool):
     """Tool for retrieving course outline with lesson structure"""
 
+    __slots__ = ("store",)
+
+    cache_ttl = 24 * 60 * 60  # Outlines are effectively static
+
+    _DEFINITION: Dict[str, Any] = {
+        "name": "get_course_outline",
+        "description": "Get the complete outline and structure of a course including all lessons",
+        "input_schema": {
+            "type": "object",
+            "properties": {
+                "course_name": {
+                    "type": "string",
+                    "description": "Course title (partial matches work, e.g. 'MCP', 'Prompt Caching')",
+                }
+            },
+            "required": ["course_name"],
+        },
+    }
+
     def __init__(self, vector_store: VectorStore):
         self.store = vector_store
 
     def get_tool_definition(self) -> Dict[str, Any]:
         """Return Anthropic tool definition for this tool"""
-        return {
-            "name": "get_course_outline",
-            "description": "Get the complete outline and structure of a course including all lessons",
-            "input_schema": {
-                "type": "object",
-                "properties": {
-                    "course_name": {
-                        "type": "string",
-                        "description": "Course title (partial matches work, e.g. 'MCP', 'Prompt Caching')",
-                    }
-                },
-                "required": ["course_name"],
-            },
-        }
+        return self._DEFINITION
 
     def execute(self, course_name: str) -> str:
         """
@@ -200,15 +245,14 @@ class CourseOutlineTool(Tool):
         if outline.get("instructor"):
             formatted.append(f"Instructor: {outline['instructor']}")
 
-        # Lessons
+        # Lessons, written in one bulk extend rather than per-line appends
         lessons = outline.get("lessons", [])
         if lessons:
             formatted.append(f"\nLessons ({len(lessons)} total):")
-            for lesson in lessons:
-                lesson_line = (
-                    f"  Lesson {lesson['lesson_number']}: {lesson['lesson_title']}"
-                )
-                formatted.append(lesson_line)
+            formatted.extend(
+                f"  Lesson {lesson['lesson_number']}: {lesson['lesson_title']}"
+                for lesson in lessons
+            )
         else:
             formatted.append("\nNo lessons found.")
 
@@ -220,6 +264,14 @@ class ToolManager:
 
     def __init__(self):
         self.tools = {}
+        # Tool definitions are static, so build the list once per registration
+        self._cached_defs: Optional[List[Dict[str, Any]]] = None
+        # LRU of (tool_name, sorted kwargs) -> (expiry time, result, sources)
+        self._cache: "OrderedDict[tuple, Tuple[float, str, List[SourceLink]]]" = (
+            OrderedDict()
+        )
+        # Concurrent queries share this manager, so guard the cache
+        self._cache_lock = threading.Lock()
 
     def register_tool(self, tool: Tool):
         """Register any tool that implements the Tool interface"""
@@ -228,28 +280,63 @@ class ToolManager:
         if not tool_name:
             raise ValueError("Tool must have a 'name' in its definition")
         self.tools[tool_name] = tool
+        self._cached_defs = None
 
     def get_tool_definitions(self) -> list:
         """Get all tool definitions for Anthropic tool calling"""
-        return [tool.get_tool_definition() for tool in self.tools.values()]
+        if self._cached_defs is None:
+            self._cached_defs = [
+                tool.get_tool_definition() for tool in self.tools.values()
+            ]
+        return self._cached_defs
+
+    def execute_tool(self, tool_name: str, **kwargs) -> Tuple[str, List[SourceLink]]:
+        """
+        Execute a tool by name with given parameters.
 
-    def execute_tool(self, tool_name: str, **kwargs) -> str:
-        """Execute a tool by name with given parameters"""
+        Returns:
+            Tuple of (tool result, sources of that result). Nothing is kept on
+            the manager, so concurrent queries never see each other's sources.
+        """
         if tool_name not in self.tools:
-            return f"Tool '{tool_name}' not found"
-
-        return self.tools[tool_name].execute(**kwargs)
-
-    def get_last_sources(self) -> List[SourceLink]:
-        """Get sources from the last search operation"""
-        # Check all tools for last_sources attribute
-        for tool in self.tools.values():
-            if hasattr(tool, "last_sources") and tool.last_sources:
-                return tool.last_sources
-        return []
-
-    def reset_sources(self):
-        """Reset sources from all tools that track sources"""
-        for tool in self.tools.values():
-            if hasattr(tool, "last_sources"):
-                tool.last_sources = []
+            return f"Tool '{tool_name}' not found", []
+
+        tool = self.tools[tool_name]
+        if tool.cache_ttl:
+            return self._run_cached(tool_name, tool, kwargs)
+        return tool.run(**kwargs)
+
+    def _run_cached(
+        self, tool_name: str, tool: Tool, kwargs: Dict[str, Any]
+    ) -> Tuple[str, List[SourceLink]]:
+        """Run a tool through the LRU cache, re-running expired entries"""
+        key = (tool_name, tuple(sorted(kwargs.items())))
+        now = time.monotonic()
+        with self._cache_lock:
+            cached = self._cache.get(key)
+            if cached is not None:
+                expires_at, result, sources = cached
+                if now < expires_at:
+                    self._cache.move_to_end(key)
+                    return result, list(sources)
+                del self._cache[key]
+
+        # Run outside the lock; sources come from this call's return value
+        result, sources = tool.run(**kwargs)
+
+        with self._cache_lock:
+            self._cache[key] = (now + tool.cache_ttl, result, list(sources))
+            self._cache.move_to_end(key)
+
+            # Drop expired entries first, then the least recently used ones
+            if len(self._cache) > TOOL_CACHE_SIZE:
+                for stale in [k for k, v in self._cache.items() if v[0] <= now]:
+                    del self._cache[stale]
+            while len(self._cache) > TOOL_CACHE_SIZE:
+                self._cache.popitem(last=False)
+        return result, sources
+
+    def clear_cache(self):
+        """Drop all cached tool results, e.g. after new content is indexed"""
+        with self._cache_lock:
+            self._cache.clear()
@@ -0,0 +1,68 @@
+from typing import Any, Callable, Generator, List, Tuple, TypeVar
+
+import orjson
+
+T = TypeVar("T")
+U = TypeVar("U")
+R = TypeVar("R")
+
+
+def relay(
+    stream: Generator[T, None, R], each: Callable[[T], U]
+) -> Generator[U, None, R]:
+    """Yield each(item) for every item of a stream, then return its value"""
+    while True:
+        try:
+            item = next(stream)
+        except StopIteration as stop:
+            return stop.value
+        yield each(item)
+
+
+def drain(stream: Generator[T, None, R]) -> Tuple[List[T], R]:
+    """Exhaust a stream, returning its items and its return value"""
+    returned = []
+
+    def collect():
+        returned.append((yield from stream))
+
+    items = list(collect())
+    return items, returned[0]
+
+
+def _event(payload: Any) -> bytes:
+    """Encode one newline-delimited JSON event"""
+    return orjson.dumps(payload) + b"\n"
+
+
+def ndjson_events(
+    query_stream: Callable[[str, str], Generator[str, None, list]],
+    query: str,
+    session_id: str,
+) -> Generator[bytes, None, None]:
+    """
+    Run a query stream and encode it as newline-delimited JSON events.
+
+    Emits {"type": "text", "text": ...} for each chunk of the answer, then a
+    final {"type": "done", "sources": [...], "session_id": ...} event, or an
+    {"type": "error", "detail": ...} event if the query fails.
+
+    Args:
+        query_stream: RAGSystem.query_stream or a stand-in with its signature
+        query: User's question
+        session_id: Session the exchange belongs to
+    """
+    try:
+        sources = yield from relay(
+            query_stream(query, session_id),
+            lambda chunk: _event({"type": "text", "text": chunk}),
+        )
+        yield _event(
+            {
+                "type": "done",
+                "sources": [source.model_dump() for source in sources or []],
+                "session_id": session_id,
+            }
+        )
+    except Exception as e:
+        yield _event({"type": "error", "detail": str(e)})
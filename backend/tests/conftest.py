@@ -1,14 +1,75 @@
 """Pytest configuration and fixtures for RAG system tests"""
 
+import asyncio
+import itertools
+import sys
+import types
+from dataclasses import dataclass
 from typing import Any, Dict, List
-from unittest.mock import MagicMock, Mock
+from unittest.mock import MagicMock, Mock, create_autospec, patch
 
+import orjson
 import pytest
 from models import Course, CourseChunk, Lesson, SourceLink
-from vector_store import SearchResults
+from vector_store import SearchResults, VectorStore
 
 
-@pytest.fixture
+class _StubBatches:
+    """Message Batches surface of the SDK client used by AIGenerator"""
+
+    def create(self, **kwargs):
+        pass
+
+    def retrieve(self, batch_id):
+        pass
+
+    def results(self, batch_id):
+        pass
+
+
+class _StubMessages:
+    """Messages surface of the SDK client used by AIGenerator"""
+
+    batches = _StubBatches()
+
+    def create(self, **kwargs):
+        pass
+
+    def stream(self, **kwargs):
+        pass
+
+
+class _StubAnthropic:
+    """Stand-in client so tests never construct the real SDK client"""
+
+    messages = _StubMessages()
+
+    def __init__(self, **kwargs):
+        pass
+
+
+# Register a lightweight fake SDK before any test module imports ai_generator,
+# so the real anthropic package (httpx, pydantic models) is never loaded.
+# Tests still patch ai_generator.anthropic.Anthropic as before.
+_fake_anthropic = types.ModuleType("anthropic")
+_fake_anthropic.Anthropic = _StubAnthropic
+sys.modules["anthropic"] = _fake_anthropic
+
+
+def pytest_addoption(parser):
+    """Register opt-in flags for the slower test groups"""
+    parser.addoption(
+        "--full-api",
+        action="store_true",
+        default=False,
+        help="also run the CORS preflight tests against the full middleware chain",
+    )
+
+# Pure-data fixtures are session scoped and shared by every test, so tests
+# must not mutate them; Mock fixtures stay function scoped to reset call history
+
+
+@pytest.fixture(scope="session")
 def sample_course():
     """Create a sample course for testing"""
     return Course(
@@ -35,7 +96,7 @@ def sample_course():
     )
 
 
-@pytest.fixture
+@pytest.fixture(scope="session")
 def sample_chunks(sample_course):
     """Create sample course chunks for testing"""
     return [
@@ -60,7 +121,7 @@ def sample_chunks(sample_course):
     ]
 
 
-@pytest.fixture
+@pytest.fixture(scope="session")
 def sample_search_results(sample_chunks):
     """Create sample SearchResults for testing"""
     return SearchResults(
@@ -82,45 +143,191 @@ def sample_search_results(sample_chunks):
     )
 
 
-@pytest.fixture
+@pytest.fixture(scope="session")
+def sample_sources():
+    """One shared source list for every mock that reports search sources"""
+    return [
+        SourceLink(text="Test Course - Lesson 0", link="https://example.com/lesson-0")
+    ]
+
+
+@pytest.fixture(scope="session")
 def empty_search_results():
     """Create empty SearchResults for testing"""
     return SearchResults(documents=[], metadata=[], distances=[], error=None)
 
 
-@pytest.fixture
+@pytest.fixture(scope="session")
 def error_search_results():
     """Create SearchResults with error for testing"""
     return SearchResults.empty("Test error: Search failed")
 
 
+@pytest.fixture(scope="module")
+def anthropic_patch():
+    """Patch the Anthropic client class once for a whole test module
+
+    Under pytest-xdist each worker is its own process, so module scope is
+    still worker-local and the mock client is never shared across workers.
+    """
+    patcher = patch("ai_generator.anthropic.Anthropic")
+    mock_anthropic_class = patcher.start()
+    # Spec the client tree once; reset_mock() then reuses it between tests
+    mock_client = create_autospec(_StubAnthropic, instance=True)
+    mock_anthropic_class.return_value = mock_client
+    yield mock_anthropic_class, mock_client
+    patcher.stop()
+
+
 @pytest.fixture
-def mock_vector_store(sample_search_results, sample_course):
-    """Create a mock VectorStore for testing"""
-    mock = Mock()
-    mock.search = Mock(return_value=sample_search_results)
-    mock.get_lesson_link = Mock(return_value="https://example.com/lesson-0")
-    mock.get_course_link = Mock(return_value="https://example.com/course")
-    mock.get_course_outline = Mock(
-        return_value={
-            "title": sample_course.title,
-            "course_link": sample_course.course_link,
-            "instructor": sample_course.instructor,
-            "lessons": [
-                {
-                    "lesson_number": lesson.lesson_number,
-                    "lesson_title": lesson.title,
-                    "lesson_link": lesson.lesson_link,
-                }
-                for lesson in sample_course.lessons
-            ],
-            "lesson_count": len(sample_course.lessons),
-        }
+def anthropic_mock(anthropic_patch):
+    """Module-wide (Anthropic class, client) mocks with call state reset per test"""
+    _, mock_client = anthropic_patch
+    mock_client.reset_mock(return_value=True, side_effect=True)
+    return anthropic_patch
+
+
+# Classes RAGSystem constructs in __init__, replaced by mocks in its tests
+RAG_COLLABORATORS = (
+    "VectorStore",
+    "AIGenerator",
+    "SessionManager",
+    "DocumentProcessor",
+)
+
+
+@dataclass(frozen=True)
+class RagMocks:
+    """The collaborator instances a patched RAGSystem is built around"""
+
+    vector_store: MagicMock
+    ai_generator: MagicMock
+    session_manager: MagicMock
+    document_processor: MagicMock
+
+
+@pytest.fixture(scope="module")
+def rag_patch():
+    """Patch RAGSystem's collaborator classes once per module"""
+    from ai_generator import AIGenerator
+
+    mocks = {name: MagicMock() for name in RAG_COLLABORATORS}
+    # Autospec the generator so calls that drift from its signature fail loudly
+    mocks["AIGenerator"].return_value = create_autospec(
+        AIGenerator, instance=True, spec_set=True
     )
-    mock.max_results = 5
+    # monkeypatch is function scoped, so open a MonkeyPatch context directly
+    with pytest.MonkeyPatch.context() as mp:
+        for name, mock_class in mocks.items():
+            mp.setattr(f"rag_system.{name}", mock_class)
+        # Fields follow RAG_COLLABORATORS order
+        yield RagMocks(*(mock_class.return_value for mock_class in mocks.values()))
+
+
+@pytest.fixture
+def rag_mocks(rag_patch):
+    """Module-wide collaborator instances, reset and pre-wired per test"""
+    # Reset the instances in place: RAGSystem holds references to them
+    for instance in vars(rag_patch).values():
+        instance.reset_mock(return_value=True, side_effect=True)
+    rag_patch.ai_generator.generate_response.return_value = ("AI response", [])
+    return rag_patch
+
+
+@pytest.fixture(scope="module")
+def shared_rag_system(rag_patch, test_config):
+    """Build one RAGSystem around the module's patched collaborators"""
+    from rag_system import RAGSystem
+
+    return RAGSystem(test_config)
+
+
+@pytest.fixture
+def rag_system(shared_rag_system, rag_mocks):
+    """The module's shared RAGSystem, over collaborators reset for this test"""
+    return shared_rag_system
+
+
+@pytest.fixture(scope="session")
+def tool_rag_system(test_config):
+    """A RAGSystem with real tools over a mocked store, plus its tool definitions"""
+    from rag_system import RAGSystem
+
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setattr("rag_system.VectorStore", MagicMock())
+        mp.setattr("rag_system.DocumentProcessor", MagicMock())
+        rag_system = RAGSystem(test_config)
+    # Definitions are deterministic for a config, so build the list once
+    return rag_system, rag_system.tool_manager.get_tool_definitions()
+
+
+class _FakeVectorStore:
+    """Plain VectorStore stand-in for tests that only need search forwarding"""
+
+    __slots__ = ("search_results", "lesson_link", "search_calls")
+
+    def __init__(self, search_results, lesson_link=None):
+        self.search_results = search_results
+        self.lesson_link = lesson_link
+        # (query, course_name, lesson_number) for every search() call
+        self.search_calls = []
+
+    def search(self, query, course_name=None, lesson_number=None):
+        self.search_calls.append((query, course_name, lesson_number))
+        return self.search_results
+
+    def get_lesson_links_batch(self, pairs):
+        return {pair: self.lesson_link for pair in pairs}
+
+
+@pytest.fixture
+def fake_vector_store(sample_search_results):
+    """A Mock-free vector store that records its search calls in a list"""
+    return _FakeVectorStore(sample_search_results, "https://example.com/lesson-0")
+
+
+def _stub_vector_store(mock, search_results, course):
+    """Apply the default return values the search tool tests expect"""
+    mock.search.return_value = search_results
+    mock.get_lesson_link.return_value = "https://example.com/lesson-0"
+    mock.get_lesson_links_batch.side_effect = lambda pairs: {
+        pair: "https://example.com/lesson-0" for pair in pairs
+    }
+    mock.get_course_link.return_value = "https://example.com/course"
+    mock.get_course_outline.return_value = {
+        "title": course.title,
+        "course_link": course.course_link,
+        "instructor": course.instructor,
+        "lessons": [
+            {
+                "lesson_number": lesson.lesson_number,
+                "lesson_title": lesson.title,
+                "lesson_link": lesson.lesson_link,
+            }
+            for lesson in course.lessons
+        ],
+        "lesson_count": len(course.lessons),
+    }
     return mock
 
 
+@pytest.fixture(scope="session")
+def shared_mock_vector_store(sample_search_results, sample_course):
+    """One mock VectorStore built for the whole session"""
+    # spec_set rejects calls to or stubs of methods VectorStore does not have
+    mock = create_autospec(VectorStore, instance=True, spec_set=True)
+    return _stub_vector_store(mock, sample_search_results, sample_course)
+
+
+@pytest.fixture
+def mock_vector_store(shared_mock_vector_store, sample_search_results, sample_course):
+    """Create a mock VectorStore for testing, reset to its defaults"""
+    shared_mock_vector_store.reset_mock(return_value=True, side_effect=True)
+    return _stub_vector_store(
+        shared_mock_vector_store, sample_search_results, sample_course
+    )
+
+
 @pytest.fixture
 def mock_anthropic_response_no_tools():
     """Mock Anthropic API response without tool use"""
@@ -171,7 +378,7 @@ def mock_anthropic_client(
 
 
 @pytest.fixture
-def mock_tool_manager():
+def mock_tool_manager(sample_sources):
     """Create a mock ToolManager"""
     mock = Mock()
     mock.get_tool_definitions = Mock(
@@ -189,20 +396,14 @@ def mock_tool_manager():
             }
         ]
     )
-    mock.execute_tool = Mock(return_value="[Test Course]\nTest search result content")
-    mock.get_last_sources = Mock(
-        return_value=[
-            SourceLink(
-                text="Test Course - Lesson 0", link="https://example.com/lesson-0"
-            )
-        ]
+    mock.execute_tool = Mock(
+        return_value=("[Test Course]\nTest search result content", sample_sources)
     )
-    mock.reset_sources = Mock()
     return mock
 
 
-@pytest.fixture
-def test_config():
+@pytest.fixture(scope="session")
+def test_config(tmp_path_factory):
     """Create test configuration"""
     from dataclasses import dataclass
 
@@ -210,6 +411,9 @@ def test_config():
     class TestConfig:
         ANTHROPIC_API_KEY: str = "test-api-key"
         ANTHROPIC_MODEL: str = "claude-sonnet-4-20250514"
+        ANTHROPIC_ROUTER_MODEL: str = "claude-haiku-4-5-20251001"
+        USE_MODEL_CASCADE: bool = False
+        GREEDY_RETURN: bool = False
         EMBEDDING_MODEL: str = "all-MiniLM-L6-v2"
         CHUNK_SIZE: int = 800
         CHUNK_OVERLAP: int = 100
@@ -217,38 +421,75 @@ def test_config():
         MAX_HISTORY: int = 2
         CHROMA_PATH: str = "./test_chroma_db"
 
-    return TestConfig()
+    # Anything that does reach ChromaDB writes to a throwaway session directory
+    # rather than leaving a database in the working tree
+    return TestConfig(CHROMA_PATH=str(tmp_path_factory.mktemp("chroma")))
 
 
-@pytest.fixture
-def mock_rag_system():
-    """Create a mock RAG system for API testing"""
-    mock = Mock()
-    mock.query = Mock(return_value=(
+def _stub_rag_system(mock, sources):
+    """Apply the default return values the API tests expect"""
+    mock.query.return_value = (
         "This is a test response from the RAG system.",
-        [SourceLink(text="Test Course - Lesson 0", link="https://example.com/lesson-0")]
-    ))
-    mock.get_course_analytics = Mock(return_value={
+        sources
+    )
+    mock.get_course_analytics.return_value = {
         "total_courses": 2,
         "course_titles": ["Test Course 1", "Test Course 2"]
-    })
-    mock.session_manager = Mock()
-    mock.session_manager.create_session = Mock(return_value="session_1")
-    mock.session_manager.clear_session = Mock()
+    }
+    mock.session_manager.create_session.return_value = "session_1"
+
+    # query_stream yields the answer in chunks and returns its sources
+    def query_stream(query, session_id):
+        yield "This is a test "
+        yield "response."
+        return sources
+
+    mock.query_stream.side_effect = query_stream
     return mock
 
 
+@pytest.fixture(scope="session")
+def shared_mock_rag_system(sample_sources):
+    """One mock RAG system behind the session-wide test app"""
+    return _stub_rag_system(Mock(), sample_sources)
+
+
 @pytest.fixture
-def test_app(mock_rag_system):
-    """Create a test FastAPI app with mocked dependencies"""
+def mock_rag_system(shared_mock_rag_system, sample_sources):
+    """Create a mock RAG system for API testing, reset to its defaults"""
+    shared_mock_rag_system.reset_mock(return_value=True, side_effect=True)
+    return _stub_rag_system(shared_mock_rag_system, sample_sources)
+
+
+def _query_stream_endpoint(mock_rag_system, request_model):
+    """Build a /api/query/stream handler over app.py's own NDJSON encoder"""
+    from fastapi.responses import StreamingResponse
+    from streaming import ndjson_events
+
+    async def query_documents_stream(request: request_model):
+        session_id = request.session_id or mock_rag_system.session_manager.create_session()
+        events = ndjson_events(mock_rag_system.query_stream, request.query, session_id)
+        return StreamingResponse(events, media_type="application/x-ndjson")
+
+    return query_documents_stream
+
+
+@pytest.fixture(scope="session")
+def test_app(shared_mock_rag_system):
+    """Create a test FastAPI app with mocked dependencies, once per session"""
+    mock_rag_system = shared_mock_rag_system
     from fastapi import FastAPI
     from fastapi.middleware.cors import CORSMiddleware
+    from fastapi.responses import ORJSONResponse
     from pydantic import BaseModel
     from typing import List, Optional
     from models import SourceLink
 
     # Create test app
-    app = FastAPI(title="Test Course Materials RAG System")
+    app = FastAPI(
+        title="Test Course Materials RAG System",
+        default_response_class=ORJSONResponse,
+    )
 
     # Add CORS middleware
     app.add_middleware(
@@ -279,19 +520,29 @@ def test_app(mock_rag_system):
         from fastapi import HTTPException
         try:
             session_id = request.session_id or mock_rag_system.session_manager.create_session()
-            answer, sources = mock_rag_system.query(request.query, session_id)
-            return QueryResponse(answer=answer, sources=sources, session_id=session_id)
+            answer, sources = await asyncio.to_thread(
+                mock_rag_system.query, request.query, session_id
+            )
+            return ORJSONResponse(
+                QueryResponse(answer=answer, sources=sources, session_id=session_id).model_dump()
+            )
         except Exception as e:
             raise HTTPException(status_code=500, detail=str(e))
 
+    app.post("/api/query/stream")(
+        _query_stream_endpoint(mock_rag_system, QueryRequest)
+    )
+
     @app.get("/api/courses", response_model=CourseStats)
     async def get_course_stats():
         from fastapi import HTTPException
         try:
-            analytics = mock_rag_system.get_course_analytics()
-            return CourseStats(
-                total_courses=analytics["total_courses"],
-                course_titles=analytics["course_titles"]
+            analytics = await asyncio.to_thread(mock_rag_system.get_course_analytics)
+            return ORJSONResponse(
+                CourseStats(
+                    total_courses=analytics["total_courses"],
+                    course_titles=analytics["course_titles"]
+                ).model_dump()
             )
         except Exception as e:
             raise HTTPException(status_code=500, detail=str(e))
@@ -308,8 +559,41 @@ def test_app(mock_rag_system):
     return app
 
 
-@pytest.fixture
-def test_client(test_app):
-    """Create a test client for the FastAPI app"""
+@pytest.fixture(scope="session")
+def shared_test_client(test_app):
+    """One test client for the session-wide FastAPI app"""
     from fastapi.testclient import TestClient
-    return TestClient(test_app)
+
+    # Entered once so app startup/shutdown runs a single time per session;
+    # unhandled errors come back as 500 responses instead of being re-raised
+    with TestClient(test_app, raise_server_exceptions=False) as client:
+        yield client
+
+
+@pytest.fixture(scope="session")
+def json_of():
+    """Decode a response body with orjson rather than httpx's stdlib json"""
+    return lambda response: orjson.loads(response.content)
+
+
+@pytest.fixture(scope="session")
+def next_session_id():
+    """Session ID factory; IDs keep increasing across every test that uses it"""
+    counter = itertools.count(1)
+    return lambda: f"session_{next(counter)}"
+
+
+@pytest.fixture
+async def async_client(test_app, mock_rag_system):
+    """Async client driving the test app in-process, for concurrent requests"""
+    import httpx
+
+    transport = httpx.ASGITransport(app=test_app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        yield client
+
+
+@pytest.fixture
+def test_client(shared_test_client, mock_rag_system):
+    """Create a test client for the FastAPI app, with the RAG mock reset"""
+    return shared_test_client
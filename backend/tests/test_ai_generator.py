@@ -1,9 +1,109 @@
 """Tests for AI generator functionality"""
 
-from unittest.mock import MagicMock, Mock, patch
-
+import threading
+import time
+from contextlib import nullcontext
+from functools import lru_cache
+from itertools import chain, repeat
+from types import SimpleNamespace
+from unittest.mock import patch
+
+import numpy as np
 import pytest
-from ai_generator import AIGenerator
+from ai_generator import (
+    GREEDY_RETURN_MIN_CHARS,
+    MAX_TOOL_ROUNDS,
+    AIGenerator,
+    SemanticResponseCache,
+)
+from models import SourceLink
+from streaming import drain
+
+# Keep this module on one xdist worker so the shared generator is built once
+pytestmark = pytest.mark.xdist_group("ai_gen")
+
+HISTORY = [
+    {"role": "user", "content": "Previous question"},
+    {"role": "assistant", "content": "Previous answer"},
+]
+
+# Tool names and guidance heading the system prompt must mention
+_EXPECTED_PROMPT_TOKENS = (
+    "search_course_content",
+    "get_course_outline",
+    "When to Use Each Tool",
+)
+
+# Tool lists are built once and shared; tuples keep tests from mutating them
+_TOOL_TEST = ({"name": "test_tool"},)
+_TOOL_SEARCH = ({"name": "search_course_content"},)
+_TOOL_OUTLINE = ({"name": "get_course_outline"},)
+_TOOLS_BOTH = (*_TOOL_SEARCH, *_TOOL_OUTLINE)
+_TOOL_DEFS_FULL = (
+    {
+        "name": "test_tool",
+        "description": "A test tool",
+        "input_schema": {"type": "object", "properties": {}},
+    },
+)
+
+
+@lru_cache(maxsize=None)
+def _text_block(text):
+    """Build a text content block, shared between calls with the same text"""
+    return SimpleNamespace(type="text", text=text)
+
+
+def _tool_block(name, id, input):
+    """Build a tool_use content block"""
+    return SimpleNamespace(type="tool_use", name=name, id=id, input=input)
+
+
+def _text(text):
+    """Build a plain end_turn response carrying a single text block"""
+    return SimpleNamespace(stop_reason="end_turn", content=[_text_block(text)])
+
+
+def _tool_use(name, id, input, text=None):
+    """Build a tool_use response, optionally preceded by text the model wrote"""
+    content = [_text_block(text)] if text is not None else []
+    content.append(_tool_block(name, id, input))
+    return SimpleNamespace(stop_reason="tool_use", content=content)
+
+
+class FakeToolManager:
+    """Minimal tool manager that records execute_tool calls"""
+
+    def __init__(self, *results, sources=()):
+        # Results are returned in call order, repeating the last one; every
+        # call returns the same sources
+        self.calls = []
+        self._results = results or ("Result",)
+        self._sources = list(sources)
+
+    def execute_tool(self, name, **kwargs):
+        self.calls.append((name, kwargs))
+        result = self._results[min(len(self.calls), len(self._results)) - 1]
+        return result, self._sources
+
+
+@pytest.fixture(scope="session")
+def sys_prompt():
+    """The static system prompt shared by every API call"""
+    return AIGenerator.SYSTEM_PROMPT
+
+
+@pytest.fixture(scope="module")
+def shared_generator(anthropic_patch):
+    """Build one AIGenerator around the module's mocked Anthropic client"""
+    return AIGenerator(api_key="test-key", model="test-model")
+
+
+@pytest.fixture
+def generator(shared_generator, anthropic_mock):
+    """The module's shared AIGenerator, with its response cache cleared"""
+    shared_generator._response_cache.clear()
+    return shared_generator
 
 
 class TestAIGenerator:
@@ -18,503 +118,597 @@ class TestAIGenerator:
         assert generator.base_params["temperature"] == 0
         assert generator.base_params["max_tokens"] == 800
 
-    @patch("ai_generator.anthropic.Anthropic")
-    def test_generate_response_without_tools(self, mock_anthropic_class):
-        """Test generate_response() without tools returns text response"""
-        # Setup mock
-        mock_client = Mock()
-        mock_anthropic_class.return_value = mock_client
+    @pytest.mark.parametrize(
+        "history,tools,expected_key,expected_val",
+        [
+            (None, None, "messages", [{"role": "user", "content": "test query"}]),
+            (None, None, "system", [AIGenerator.SYSTEM_BLOCK]),
+            (
+                HISTORY,
+                None,
+                "messages",
+                [*HISTORY, {"role": "user", "content": "test query"}],
+            ),
+            (HISTORY, None, "system", [AIGenerator.SYSTEM_BLOCK]),
+            (
+                None,
+                _TOOL_DEFS_FULL,
+                "tools",
+                [{**_TOOL_DEFS_FULL[0], "cache_control": {"type": "ephemeral"}}],
+            ),
+            (None, _TOOL_DEFS_FULL, "tool_choice", {"type": "auto"}),
+        ],
+        ids=[
+            "query-only",
+            "static-system",
+            "history-as-messages",
+            "history-keeps-system",
+            "tools-cache-breakpoint",
+            "tool-choice-auto",
+        ],
+    )
+    def test_generate_response_shapes(
+        self, anthropic_mock, generator, history, tools, expected_key, expected_val
+    ):
+        """Test that generate_response() builds the expected API parameters"""
+        _, mock_client = anthropic_mock
+        mock_client.messages.create.return_value = _text("Test response")
+
+        result, _ = generator.generate_response(
+            query="test query",
+            conversation_history=history,
+            tools=tools,
+            tool_manager=FakeToolManager() if tools else None,
+        )
+
+        assert result == "Test response"
+        call_args = mock_client.messages.create.call_args.kwargs
+        assert mock_client.messages.create.call_count == 1
+        assert call_args[expected_key] == expected_val
+        # Caller's history and tool definitions are left untouched
+        assert len(HISTORY) == 2
+        assert "cache_control" not in _TOOL_DEFS_FULL[0]
+
+    def test_tool_execution_full_flow(self, anthropic_mock, generator):
+        """Test tool execution, message building and tool withdrawal in one run"""
+        _, mock_client = anthropic_mock
+
+        # Two tool_use rounds (the maximum), then the final response
+        search_response = _tool_use(
+            "search_course_content", "tool_123", {"query": "test"}
+        )
+        outline_response = _tool_use(
+            "get_course_outline", "tool_456", {"course_name": "MCP"}
+        )
+        mock_client.messages.create.side_effect = [
+            search_response,
+            outline_response,
+            _text("Final response after tool"),
+        ]
+
+        source = SourceLink(text="MCP - Lesson 1", link=None)
+        tool_manager = FakeToolManager(
+            "Tool executed successfully", "Outline", sources=[source]
+        )
+
+        result, sources = generator.generate_response(
+            query="user query",
+            tools=_TOOLS_BOTH,
+            tool_manager=tool_manager,
+        )
+
+        # (a) The final text and its tool sources are returned after every round
+        assert result == "Final response after tool"
+        assert sources == [source]
+        calls = mock_client.messages.create.call_args_list
+        assert len(calls) == MAX_TOOL_ROUNDS + 1
+
+        # (b) Each requested tool was executed with its input
+        assert tool_manager.calls == [
+            ("search_course_content", {"query": "test"}),
+            ("get_course_outline", {"course_name": "MCP"}),
+        ]
+
+        # (c) The final call carries the query, then each round's assistant
+        # tool_use and user tool_result
+        assert calls[-1].kwargs["messages"] == [
+            {"role": "user", "content": "user query"},
+            {"role": "assistant", "content": search_response.content},
+            {
+                "role": "user",
+                "content": [
+                    {
+                        "type": "tool_result",
+                        "tool_use_id": "tool_123",
+                        "content": "Tool executed successfully",
+                    }
+                ],
+            },
+            {"role": "assistant", "content": outline_response.content},
+            {
+                "role": "user",
+                "content": [
+                    {
+                        "type": "tool_result",
+                        "tool_use_id": "tool_456",
+                        "content": "Outline",
+                    }
+                ],
+            },
+        ]
+
+        # (d) Tools stay available until MAX_TOOL_ROUNDS, then are withdrawn
+        assert "tools" in calls[1].kwargs
+        assert "tools" not in calls[2].kwargs
+
+    def test_system_prompt_contains_tool_guidance(self, sys_prompt):
+        """Test that system prompt names both tools and gives usage guidance"""
+        missing = [t for t in _EXPECTED_PROMPT_TOKENS if t not in sys_prompt]
+        assert missing == []
+
 
-        mock_response = Mock()
-        mock_response.stop_reason = "end_turn"
-        mock_response.content = [Mock(text="Test response")]
+class TestResponseCache:
+    """Tests for the exact-match response cache"""
 
+    def test_identical_query_served_from_cache(self, anthropic_mock, generator):
+        """Test that a repeated identical query skips the API call"""
+        _, mock_client = anthropic_mock
+
+        mock_response = _text("Cached answer")
         mock_client.messages.create.return_value = mock_response
 
-        # Create generator and call
-        generator = AIGenerator(api_key="test-key", model="test-model")
-        result = generator.generate_response(query="test query")
+        first = generator.generate_response(query="What is MCP?")
+        second = generator.generate_response(query="What is MCP?")
 
-        # Verify
-        assert result == "Test response"
-        assert mock_client.messages.create.called
-        call_args = mock_client.messages.create.call_args[1]
-        assert call_args["messages"][0]["content"] == "test query"
-        assert call_args["system"] == AIGenerator.SYSTEM_PROMPT
-
-    @patch("ai_generator.anthropic.Anthropic")
-    def test_generate_response_with_conversation_history(self, mock_anthropic_class):
-        """Test that conversation history is included in system prompt"""
-        # Setup mock
-        mock_client = Mock()
-        mock_anthropic_class.return_value = mock_client
-
-        mock_response = Mock()
-        mock_response.stop_reason = "end_turn"
-        mock_response.content = [Mock(text="Test response")]
+        assert first == second == ("Cached answer", [])
+        assert mock_client.messages.create.call_count == 1
 
+    def test_empty_answer_not_cached(self, anthropic_mock, generator):
+        """Test that an empty answer is asked for again rather than replayed"""
+        _, mock_client = anthropic_mock
+        mock_client.messages.create.return_value = _text("")
+
+        generator.generate_response(query="What is MCP?")
+        generator.generate_response(query="What is MCP?")
+
+        assert mock_client.messages.create.call_count == 2
+
+    def test_different_history_misses_cache(self, anthropic_mock, generator):
+        """Test that conversation history is part of the cache key"""
+        _, mock_client = anthropic_mock
+
+        mock_response = _text("Answer")
         mock_client.messages.create.return_value = mock_response
 
-        # Create generator and call with history
-        generator = AIGenerator(api_key="test-key", model="test-model")
-        history = "User: Previous question\nAssistant: Previous answer"
-        result = generator.generate_response(
-            query="test query", conversation_history=history
+        generator.generate_response(query="query")
+        generator.generate_response(
+            query="query",
+            conversation_history=[
+                {"role": "user", "content": "hi"},
+                {"role": "assistant", "content": "hello"},
+            ],
         )
 
-        # Verify history is in system content
-        call_args = mock_client.messages.create.call_args[1]
-        assert history in call_args["system"]
-        assert AIGenerator.SYSTEM_PROMPT in call_args["system"]
+        assert mock_client.messages.create.call_count == 2
+
+    def test_tool_based_responses_not_cached(self, anthropic_mock, generator):
+        """Test that responses produced via tool execution are not cached"""
+        _, mock_client = anthropic_mock
+
+        tool_response = _tool_use("test_tool", "id_1", {})
+
+        final_response = _text("Tool answer")
+
+        mock_client.messages.create.side_effect = [tool_response, final_response] * 2
+
+        tool_manager = FakeToolManager("Result")
+
+        for _ in range(2):
+            generator.generate_response(
+                query="query",
+                tools=_TOOL_TEST,
+                tool_manager=tool_manager,
+            )
+
+        assert mock_client.messages.create.call_count == 4
+        assert len(tool_manager.calls) == 2
+
+
+class TestSemanticResponseCache:
+    """Tests for the embedding-similarity response cache"""
+
+    # Paraphrases share a direction; the unrelated query is orthogonal
+    EMBEDDINGS = {
+        "What is lesson 2?": [1.0, 0.0, 0.0],
+        "Tell me about lesson 2": [0.99, 0.01, 0.0],
+        "Who teaches the course?": [0.0, 1.0, 0.0],
+    }
 
-    @patch("ai_generator.anthropic.Anthropic")
-    def test_generate_response_with_tools(self, mock_anthropic_class):
-        """Test that tools are passed to the API when provided"""
-        # Setup mock
-        mock_client = Mock()
-        mock_anthropic_class.return_value = mock_client
+    def embed(self, texts):
+        return [self.EMBEDDINGS[text] for text in texts]
 
-        mock_response = Mock()
-        mock_response.stop_reason = "end_turn"
-        mock_response.content = [Mock(text="Test response")]
+    def test_paraphrased_query_served_from_cache(self, anthropic_mock):
+        """Test that a near-duplicate query reuses the cached response"""
+        _, mock_client = anthropic_mock
 
+        mock_response = _text("Lesson 2 answer")
         mock_client.messages.create.return_value = mock_response
 
-        # Create generator
-        generator = AIGenerator(api_key="test-key", model="test-model")
+        generator = AIGenerator(
+            api_key="test-key", model="test-model", embedding_function=self.embed
+        )
+        generator.generate_response(query="What is lesson 2?")
+        result, _ = generator.generate_response(query="Tell me about lesson 2")
+        generator.generate_response(query="Who teaches the course?")
 
-        tool_definitions = [
-            {
-                "name": "test_tool",
-                "description": "A test tool",
-                "input_schema": {"type": "object", "properties": {}},
-            }
-        ]
+        assert result == "Lesson 2 answer"
+        assert mock_client.messages.create.call_count == 2
 
-        result = generator.generate_response(
-            query="test query", tools=tool_definitions, tool_manager=Mock()
-        )
-
-        # Verify tools were passed
-        call_args = mock_client.messages.create.call_args[1]
-        assert "tools" in call_args
-        assert call_args["tools"] == tool_definitions
-        assert call_args["tool_choice"] == {"type": "auto"}
-
-    @patch("ai_generator.anthropic.Anthropic")
-    def test_generate_response_triggers_tool_execution(self, mock_anthropic_class):
-        """Test that tool_use stop_reason triggers _handle_tool_execution"""
-        # Setup mock
-        mock_client = Mock()
-        mock_anthropic_class.return_value = mock_client
-
-        # First response with tool use
-        tool_use_response = Mock()
-        tool_use_response.stop_reason = "tool_use"
-        tool_block = Mock()
-        tool_block.type = "tool_use"
-        tool_block.name = "test_tool"
-        tool_block.id = "tool_123"
-        tool_block.input = {"param": "value"}
-        tool_use_response.content = [tool_block]
-
-        # Second response after tool execution
-        final_response = Mock()
-        final_response.stop_reason = "end_turn"
-        final_response.content = [Mock(text="Final response after tool")]
-
-        mock_client.messages.create.side_effect = [tool_use_response, final_response]
-
-        # Create mock tool manager
-        mock_tool_manager = Mock()
-        mock_tool_manager.execute_tool.return_value = "Tool result"
-
-        # Create generator and call
-        generator = AIGenerator(api_key="test-key", model="test-model")
-        result = generator.generate_response(
-            query="test query",
-            tools=[{"name": "test_tool"}],
-            tool_manager=mock_tool_manager,
+    def test_user_query_embedded_instead_of_prompt(self, anthropic_mock):
+        """Test that a shared prompt prefix is left out of the embedding"""
+        _, mock_client = anthropic_mock
+        mock_client.messages.create.return_value = _text("Lesson 2 answer")
+        embedded = []
+
+        def embed(texts):
+            embedded.extend(texts)
+            return self.embed(texts)
+
+        generator = AIGenerator(
+            api_key="test-key", model="test-model", embedding_function=embed
         )
+        for question in ["What is lesson 2?", "Tell me about lesson 2"]:
+            generator.generate_response(
+                query=f"Answer this question about course materials: {question}",
+                user_query=question,
+            )
 
-        # Verify tool was executed
-        assert result == "Final response after tool"
-        mock_tool_manager.execute_tool.assert_called_once_with(
-            "test_tool", param="value"
+        assert embedded == ["What is lesson 2?", "Tell me about lesson 2"]
+        assert mock_client.messages.create.call_count == 1
+
+    @pytest.mark.slow
+    def test_near_miss_queries_not_served_from_cache(self, anthropic_mock, test_config):
+        """Test with the real embedder that neighbouring lessons do not collide"""
+        sentence_transformers = pytest.importorskip("sentence_transformers")
+        model = sentence_transformers.SentenceTransformer(test_config.EMBEDDING_MODEL)
+        _, mock_client = anthropic_mock
+        mock_client.messages.create.return_value = _text("Answer")
+
+        generator = AIGenerator(
+            api_key="test-key",
+            model="test-model",
+            embedding_function=lambda texts: model.encode(list(texts)),
         )
+        for question in [
+            "What is covered in lesson 2?",
+            "What is covered in lesson 3?",
+        ]:
+            generator.generate_response(
+                query=f"Answer this question about course materials: {question}",
+                user_query=question,
+            )
 
-        # Verify second API call was made
         assert mock_client.messages.create.call_count == 2
 
-    @patch("ai_generator.anthropic.Anthropic")
-    def test_handle_tool_execution_formats_messages_correctly(
-        self, mock_anthropic_class
-    ):
-        """Test that _handle_tool_execution formats message history correctly"""
-        # Setup mock
-        mock_client = Mock()
-        mock_anthropic_class.return_value = mock_client
-
-        # First response with tool use
-        tool_use_response = Mock()
-        tool_use_response.stop_reason = "tool_use"
-        tool_block = Mock()
-        tool_block.type = "tool_use"
-        tool_block.name = "test_tool"
-        tool_block.id = "tool_123"
-        tool_block.input = {"query": "test"}
-        tool_use_response.content = [tool_block]
-
-        # Second response
-        final_response = Mock()
-        final_response.stop_reason = "end_turn"
-        final_response.content = [Mock(text="Final")]
-
-        mock_client.messages.create.side_effect = [tool_use_response, final_response]
-
-        # Create mock tool manager
-        mock_tool_manager = Mock()
-        mock_tool_manager.execute_tool.return_value = "Tool executed successfully"
-
-        # Create generator and call
-        generator = AIGenerator(api_key="test-key", model="test-model")
-        result = generator.generate_response(
-            query="user query",
-            tools=[{"name": "test_tool"}],
-            tool_manager=mock_tool_manager,
-        )
-
-        # Get the second API call (after tool execution)
-        second_call_args = mock_client.messages.create.call_args_list[1][1]
-
-        # Verify message structure
-        messages = second_call_args["messages"]
-        assert (
-            len(messages) == 3
-        )  # user, assistant with tool_use, user with tool_result
-
-        # First message: user query
-        assert messages[0]["role"] == "user"
-        assert messages[0]["content"] == "user query"
-
-        # Second message: assistant with tool use
-        assert messages[1]["role"] == "assistant"
-        assert messages[1]["content"] == tool_use_response.content
-
-        # Third message: tool results
-        assert messages[2]["role"] == "user"
-        assert isinstance(messages[2]["content"], list)
-        assert messages[2]["content"][0]["type"] == "tool_result"
-        assert messages[2]["content"][0]["tool_use_id"] == "tool_123"
-        assert messages[2]["content"][0]["content"] == "Tool executed successfully"
-
-    @patch("ai_generator.anthropic.Anthropic")
-    def test_handle_tool_execution_no_tools_in_final_call(self, mock_anthropic_class):
-        """Test that final API call after tool execution doesn't include tools"""
-        # Setup mock
-        mock_client = Mock()
-        mock_anthropic_class.return_value = mock_client
-
-        # First response with tool use
-        tool_use_response = Mock()
-        tool_use_response.stop_reason = "tool_use"
-        tool_block = Mock()
-        tool_block.type = "tool_use"
-        tool_block.name = "test_tool"
-        tool_block.id = "tool_123"
-        tool_block.input = {}
-        tool_use_response.content = [tool_block]
-
-        # Second response also with tool_use (to test sequential calling)
-        second_response = Mock()
-        second_response.stop_reason = "tool_use"
-        second_block = Mock()
-        second_block.type = "tool_use"
-        second_block.name = "test_tool_2"
-        second_block.id = "tool_456"
-        second_block.input = {}
-        second_response.content = [second_block]
+    def test_paraphrase_with_different_history_misses(self, anthropic_mock):
+        """Test that a similar query in a different context is not reused"""
+        _, mock_client = anthropic_mock
 
-        # Final response
-        final_response = Mock()
-        final_response.stop_reason = "end_turn"
-        final_response.content = [Mock(text="Final")]
+        mock_response = _text("Answer")
+        mock_client.messages.create.return_value = mock_response
 
-        mock_client.messages.create.side_effect = [
-            tool_use_response,
-            second_response,
-            final_response,
-        ]
+        generator = AIGenerator(
+            api_key="test-key", model="test-model", embedding_function=self.embed
+        )
+        generator.generate_response(query="What is lesson 2?")
+        generator.generate_response(
+            query="Tell me about lesson 2",
+            conversation_history=[
+                {"role": "user", "content": "Course A?"},
+                {"role": "assistant", "content": "Yes"},
+            ],
+        )
 
-        # Create generator and call
-        generator = AIGenerator(api_key="test-key", model="test-model")
-        mock_tool_manager = Mock()
-        mock_tool_manager.execute_tool.return_value = "Result"
+        assert mock_client.messages.create.call_count == 2
 
-        result = generator.generate_response(
-            query="test",
-            tools=[{"name": "test_tool"}, {"name": "test_tool_2"}],
-            tool_manager=mock_tool_manager,
-        )
+    def test_match_found_despite_better_match_in_other_context(self):
+        """Test that a closer entry from another context does not hide a match"""
+        cache = SemanticResponseCache(self.embed)
+        exact = cache.embed("What is lesson 2?")
+        paraphrase = cache.embed("Tell me about lesson 2")
 
-        # Verify final call (3rd call, after MAX_TOOL_ROUNDS=2) doesn't have tools
-        final_call_args = mock_client.messages.create.call_args_list[2][1]
-        assert (
-            "tools" not in final_call_args
-        ), "Tools should not be included after MAX_TOOL_ROUNDS"
+        cache.store(exact, "other", "other context answer")
+        cache.store(paraphrase, "ctx", "same context answer")
 
-    @patch("ai_generator.anthropic.Anthropic")
-    def test_system_prompt_contains_tool_guidance(self, mock_anthropic_class):
-        """Test that system prompt contains guidance for both tools"""
-        mock_client = Mock()
-        mock_anthropic_class.return_value = mock_client
+        assert cache.lookup(exact, "ctx") == "same context answer"
 
-        mock_response = Mock()
-        mock_response.stop_reason = "end_turn"
-        mock_response.content = [Mock(text="Test")]
+    def test_least_recently_used_entry_evicted(self):
+        """Test that the cache evicts the least recently used entry when full"""
+        cache = SemanticResponseCache(self.embed, max_size=2)
+        first = cache.embed("What is lesson 2?")
+        second = cache.embed("Who teaches the course?")
 
-        mock_client.messages.create.return_value = mock_response
+        cache.store(first, "ctx", "first")
+        cache.store(second, "ctx", "second")
+        assert cache.lookup(first, "ctx") == "first"
 
-        generator = AIGenerator(api_key="test-key", model="test-model")
-        generator.generate_response(query="test")
+        third = np.array([0.0, 0.0, 1.0], dtype=np.float32)
+        cache.store(third, "ctx", "third")
 
-        # Check that system prompt mentions both tools
-        assert "search_course_content" in AIGenerator.SYSTEM_PROMPT
-        assert "get_course_outline" in AIGenerator.SYSTEM_PROMPT
-        # Check guidance is present
-        assert "When to Use Each Tool" in AIGenerator.SYSTEM_PROMPT
+        assert cache.lookup(first, "ctx") == "first"
+        assert cache.lookup(second, "ctx") is None
+        assert cache.lookup(third, "ctx") == "third"
 
 
-class TestSequentialToolCalling:
-    """Tests for sequential tool calling functionality"""
+class TestModelCascade:
+    """Tests for routing tool calls to a cheaper model"""
 
-    @patch("ai_generator.anthropic.Anthropic")
-    def test_single_round_tool_use_still_works(self, mock_anthropic_class):
-        """Test that single round tool calling still works (backward compatibility)"""
-        mock_client = Mock()
-        mock_anthropic_class.return_value = mock_client
+    @pytest.mark.parametrize(
+        "rounds", [1, MAX_TOOL_ROUNDS], ids=["one_round", "max_rounds"]
+    )
+    def test_router_model_used_only_before_tool_results(self, anthropic_mock, rounds):
+        """Test that every call after tool results uses the main model"""
+        _, mock_client = anthropic_mock
 
-        # First response with tool use
-        tool_response = Mock()
-        tool_response.stop_reason = "tool_use"
-        tool_block = Mock(type="tool_use", name="test_tool", id="tool_1", input={})
-        tool_response.content = [tool_block]
+        tool_response = _tool_use("test_tool", "id", {})
+        final_response = _text("Final")
+        mock_client.messages.create.side_effect = chain(
+            repeat(tool_response, rounds), [final_response]
+        )
 
-        # Second response with end_turn
-        final_response = Mock()
-        final_response.stop_reason = "end_turn"
-        final_response.content = [Mock(text="Final response")]
+        tool_manager = FakeToolManager("Result")
 
-        mock_client.messages.create.side_effect = [tool_response, final_response]
+        generator = AIGenerator(
+            api_key="test-key", model="main-model", router_model="router-model"
+        )
+        result, _ = generator.generate_response(
+            query="query", tools=_TOOL_TEST, tool_manager=tool_manager
+        )
 
-        # Create generator and tool manager
-        mock_tool_manager = Mock()
-        mock_tool_manager.execute_tool.return_value = "Tool result"
+        assert result == "Final"
+        models = [c.kwargs["model"] for c in mock_client.messages.create.call_args_list]
+        assert models == ["router-model"] + ["main-model"] * rounds
 
-        generator = AIGenerator(api_key="test-key", model="test-model")
-        result = generator.generate_response(
-            query="test query",
-            tools=[{"name": "test_tool"}],
-            tool_manager=mock_tool_manager,
+    def test_without_router_model_main_model_used(self, anthropic_mock):
+        """Test that the cascade is off when no router model is given"""
+        _, mock_client = anthropic_mock
+        mock_client.messages.create.return_value = _text("Answer")
+
+        generator = AIGenerator(api_key="test-key", model="main-model")
+        generator.generate_response(query="query", tools=_TOOL_TEST)
+
+        assert mock_client.messages.create.call_args.kwargs["model"] == "main-model"
+
+
+class TestStreaming:
+    """Tests for streaming response generation"""
+
+    @staticmethod
+    def _make_stream(chunks, final_message):
+        """Build a messages.stream() context manager yielding the given chunks"""
+        return nullcontext(
+            SimpleNamespace(
+                text_stream=iter(chunks), get_final_message=lambda: final_message
+            )
         )
 
-        # Verify
-        assert result == "Final response"
-        assert mock_client.messages.create.call_count == 2
-        mock_tool_manager.execute_tool.assert_called_once()
+    def test_stream_yields_text_and_caches_result(self, anthropic_mock, generator):
+        """Test that text deltas are yielded and the joined text is cached"""
+        _, mock_client = anthropic_mock
 
-    @patch("ai_generator.anthropic.Anthropic")
-    def test_two_rounds_of_tool_execution(self, mock_anthropic_class):
-        """Test that two sequential rounds of tool calling work"""
-        mock_client = Mock()
-        mock_anthropic_class.return_value = mock_client
+        final_message = SimpleNamespace(stop_reason="end_turn")
+        mock_client.messages.stream.return_value = self._make_stream(
+            ["Hello", ", world"], final_message
+        )
 
-        # Round 1: tool use
-        round1_response = Mock()
-        round1_response.stop_reason = "tool_use"
-        tool1 = Mock(type="tool_use", name="tool_1", id="id_1", input={"param": "val1"})
-        round1_response.content = [tool1]
-
-        # Round 2: tool use again
-        round2_response = Mock()
-        round2_response.stop_reason = "tool_use"
-        tool2 = Mock(type="tool_use", name="tool_2", id="id_2", input={"param": "val2"})
-        round2_response.content = [tool2]
-
-        # Round 3: final response (no tools offered)
-        final_response = Mock()
-        final_response.stop_reason = "end_turn"
-        final_response.content = [Mock(text="Final answer")]
+        chunks, sources = drain(generator.generate_response_stream(query="greet"))
 
-        mock_client.messages.create.side_effect = [
-            round1_response,
-            round2_response,
-            final_response,
-        ]
+        assert chunks == ["Hello", ", world"]
+        assert sources == []
+        # The complete answer is now served from the response cache
+        assert generator.generate_response(query="greet") == ("Hello, world", [])
+        assert not mock_client.messages.create.called
 
-        # Create tool manager
-        mock_tool_manager = Mock()
-        mock_tool_manager.execute_tool.side_effect = ["Result 1", "Result 2"]
+    def test_stream_executes_tools_between_rounds(self, anthropic_mock, generator):
+        """Test that tool rounds run first and only the final answer is yielded"""
+        _, mock_client = anthropic_mock
 
-        generator = AIGenerator(api_key="test-key", model="test-model")
-        result = generator.generate_response(
-            query="complex query",
-            tools=[{"name": "tool_1"}, {"name": "tool_2"}],
-            tool_manager=mock_tool_manager,
+        tool_message = _tool_use(
+            "search_course_content", "id_1", {"query": "mcp"}, text="Let me search"
         )
+        final_message = SimpleNamespace(stop_reason="end_turn")
 
-        # Verify
-        assert result == "Final answer"
-        assert mock_client.messages.create.call_count == 3
-        assert mock_tool_manager.execute_tool.call_count == 2
-
-    @patch("ai_generator.anthropic.Anthropic")
-    def test_maximum_rounds_enforced(self, mock_anthropic_class):
-        """Test that tool calling stops after MAX_TOOL_ROUNDS"""
-        from ai_generator import MAX_TOOL_ROUNDS
-
-        mock_client = Mock()
-        mock_anthropic_class.return_value = mock_client
-
-        # Create responses that always want to use tools
-        tool_response = Mock()
-        tool_response.stop_reason = "tool_use"
-        tool_block = Mock(type="tool_use", name="test_tool", id="tool_id", input={})
-        tool_response.content = [tool_block]
-
-        # Final response after max rounds
-        final_response = Mock()
-        final_response.stop_reason = "end_turn"
-        final_response.content = [Mock(text="Forced final")]
-
-        # Return tool_use for first MAX_TOOL_ROUNDS calls, then final
-        mock_client.messages.create.side_effect = [tool_response] * MAX_TOOL_ROUNDS + [
-            final_response
+        mock_client.messages.stream.side_effect = [
+            self._make_stream(["Let me search"], tool_message),
+            self._make_stream(["MCP ", "answer"], final_message),
         ]
 
-        mock_tool_manager = Mock()
-        mock_tool_manager.execute_tool.return_value = "Result"
+        source = SourceLink(text="MCP - Lesson 1", link=None)
+        tool_manager = FakeToolManager("Search result", sources=[source])
+
+        chunks, sources = drain(
+            generator.generate_response_stream(
+                query="What is MCP?",
+                tools=_TOOL_SEARCH,
+                tool_manager=tool_manager,
+            )
+        )
+
+        # The tool round's preamble is dropped
+        assert chunks == ["MCP ", "answer"]
+        # Sources come back as the stream's return value
+        assert sources == [source]
+        assert tool_manager.calls == [("search_course_content", {"query": "mcp"})]
+        second_kwargs = mock_client.messages.stream.call_args_list[1].kwargs
+        assert second_kwargs["messages"][2]["content"][0]["content"] == "Search result"
+
+
+class TestBatchGeneration:
+    """Tests for Message Batches API generation"""
+
+    @patch("ai_generator.time.sleep")
+    def test_generate_batch_polls_and_collects_results(
+        self, mock_sleep, anthropic_mock, generator
+    ):
+        """Test that a batch is submitted, polled until ended and collected"""
+        _, mock_client = anthropic_mock
+
+        mock_client.messages.batches.create.return_value = SimpleNamespace(
+            id="batch_1", processing_status="in_progress"
+        )
+        mock_client.messages.batches.retrieve.return_value = SimpleNamespace(
+            id="batch_1", processing_status="ended"
+        )
 
-        generator = AIGenerator(api_key="test-key", model="test-model")
-        result = generator.generate_response(
-            query="query", tools=[{"name": "test_tool"}], tool_manager=mock_tool_manager
+        succeeded = SimpleNamespace(
+            custom_id="q-0",
+            result=SimpleNamespace(
+                type="succeeded",
+                message=SimpleNamespace(content=[_text_block("Answer 0")]),
+            ),
+        )
+        errored = SimpleNamespace(
+            custom_id="q-1", result=SimpleNamespace(type="errored")
         )
+        mock_client.messages.batches.results.return_value = iter([succeeded, errored])
 
-        # Verify it stopped at MAX_TOOL_ROUNDS
-        assert result == "Forced final"
-        assert mock_client.messages.create.call_count == MAX_TOOL_ROUNDS + 1
-        assert mock_tool_manager.execute_tool.call_count == MAX_TOOL_ROUNDS
+        results = generator.generate_batch(["First?", "Second?"], poll_interval=1)
 
-    @patch("ai_generator.anthropic.Anthropic")
-    def test_tools_not_included_in_final_round(self, mock_anthropic_class):
-        """Test that tools are not included in API call after MAX_TOOL_ROUNDS"""
-        from ai_generator import MAX_TOOL_ROUNDS
+        assert results == {"q-0": "Answer 0", "q-1": None}
+        mock_sleep.assert_called_once_with(1)
+        requests = mock_client.messages.batches.create.call_args.kwargs["requests"]
+        assert [r["custom_id"] for r in requests] == ["q-0", "q-1"]
+        assert requests[1]["params"]["messages"][0]["content"] == "Second?"
+        assert "tools" not in requests[0]["params"]
 
-        mock_client = Mock()
-        mock_anthropic_class.return_value = mock_client
 
-        # Responses for MAX_TOOL_ROUNDS, then final
-        tool_response = Mock()
-        tool_response.stop_reason = "tool_use"
-        tool_block = Mock(type="tool_use", name="test_tool", id="id", input={})
-        tool_response.content = [tool_block]
+class TestSequentialToolCalling:
+    """Tests for sequential tool calling functionality"""
 
-        final_response = Mock()
-        final_response.stop_reason = "end_turn"
-        final_response.content = [Mock(text="Final")]
+    # Tests run in definition order: the core rounds contract and single-call
+    # paths first, so `pytest -x` stops before the multi-round/threaded tests
+
+    @pytest.mark.parametrize(
+        "rounds,expected_calls",
+        [(1, 2), (MAX_TOOL_ROUNDS, MAX_TOOL_ROUNDS + 1)],
+        ids=["early_termination", "max_rounds"],
+    )
+    def test_tool_rounds(self, anthropic_mock, generator, rounds, expected_calls):
+        """Test N tool rounds followed by a final answer, capped at MAX_TOOL_ROUNDS"""
+        _, mock_client = anthropic_mock
+
+        # One distinct tool per round so execution order is observable
+        mock_client.messages.create.side_effect = chain(
+            (_tool_use(f"tool_{i}", f"id_{i}", {"order": i}) for i in range(rounds)),
+            [_text("Final answer")],
+        )
 
-        mock_client.messages.create.side_effect = [tool_response] * MAX_TOOL_ROUNDS + [
-            final_response
+        tool_manager = FakeToolManager("Result")
+
+        result, _ = generator.generate_response(
+            query="query",
+            tools=[{"name": f"tool_{i}"} for i in range(rounds)],
+            tool_manager=tool_manager,
+        )
+
+        assert result == "Final answer"
+        assert mock_client.messages.create.call_count == expected_calls
+        # Tools ran once per round, in order
+        assert tool_manager.calls == [
+            (f"tool_{i}", {"order": i}) for i in range(rounds)
         ]
+        # Tools are only withdrawn from the final call once the cap is reached
+        final_kwargs = mock_client.messages.create.call_args_list[-1].kwargs
+        assert ("tools" in final_kwargs) == (rounds < MAX_TOOL_ROUNDS)
 
-        mock_tool_manager = Mock()
-        mock_tool_manager.execute_tool.return_value = "Result"
+    def test_no_tool_manager_stops_execution(self, anthropic_mock, generator):
+        """Test that tool_use without tool_manager returns immediately"""
+        _, mock_client = anthropic_mock
 
-        generator = AIGenerator(api_key="test-key", model="test-model")
-        result = generator.generate_response(
-            query="query", tools=[{"name": "test_tool"}], tool_manager=mock_tool_manager
+        # Response with tool use
+        tool_response = _tool_use("test_tool", "id", {})
+
+        mock_client.messages.create.return_value = tool_response
+
+        result, _ = generator.generate_response(
+            query="query",
+            tools=_TOOL_TEST,
+            tool_manager=None,  # No tool manager
+        )
+
+        # Content only holds a tool_use block, so there is no text to return
+        assert result == ""
+        assert mock_client.messages.create.call_count == 1
+
+    def test_tool_use_without_tool_blocks_skips_followup_call(
+        self, anthropic_mock, generator
+    ):
+        """Test that a tool_use stop with no tool_use blocks ends the loop"""
+        _, mock_client = anthropic_mock
+
+        malformed_response = SimpleNamespace(
+            stop_reason="tool_use", content=[_text_block("Partial answer")]
+        )
+        mock_client.messages.create.return_value = malformed_response
+
+        tool_manager = FakeToolManager()
+
+        result, _ = generator.generate_response(
+            query="query", tools=_TOOL_TEST, tool_manager=tool_manager
         )
 
-        # Check the final API call (after MAX_TOOL_ROUNDS)
-        final_call_args = mock_client.messages.create.call_args_list[-1][1]
-        assert (
-            "tools" not in final_call_args
-        ), "Tools should not be included in final API call"
+        assert result == "Partial answer"
+        assert mock_client.messages.create.call_count == 1
+        assert tool_manager.calls == []
 
-    @patch("ai_generator.anthropic.Anthropic")
-    def test_message_history_built_across_rounds(self, mock_anthropic_class):
+    def test_message_history_built_across_rounds(self, anthropic_mock, generator):
         """Test that message history correctly accumulates across rounds"""
-        mock_client = Mock()
-        mock_anthropic_class.return_value = mock_client
+        _, mock_client = anthropic_mock
 
         # Round 1: tool use
-        round1_response = Mock()
-        round1_response.stop_reason = "tool_use"
-        tool1 = Mock(type="tool_use", name="tool_1", id="id_1", input={})
-        round1_response.content = [tool1]
+        round1_response = _tool_use("test_tool", "id_1", {})
 
         # Round 2: end
-        round2_response = Mock()
-        round2_response.stop_reason = "end_turn"
-        round2_response.content = [Mock(text="Final")]
+        round2_response = _text("Final")
 
         mock_client.messages.create.side_effect = [round1_response, round2_response]
 
-        mock_tool_manager = Mock()
-        mock_tool_manager.execute_tool.return_value = "Tool result"
+        tool_manager = FakeToolManager("Tool result")
 
-        generator = AIGenerator(api_key="test-key", model="test-model")
-        result = generator.generate_response(
+        result, _ = generator.generate_response(
             query="user query",
-            tools=[{"name": "tool_1"}],
-            tool_manager=mock_tool_manager,
+            tools=_TOOL_TEST,
+            tool_manager=tool_manager,
         )
 
         # Verify message structure in second call
-        second_call_messages = mock_client.messages.create.call_args_list[1][1][
-            "messages"
-        ]
+        second_kwargs = mock_client.messages.create.call_args_list[1].kwargs
+        second_call_messages = second_kwargs["messages"]
         assert len(second_call_messages) == 3
         # Message 1: user query
         assert second_call_messages[0]["role"] == "user"
         assert second_call_messages[0]["content"] == "user query"
         # Message 2: assistant with tool use
         assert second_call_messages[1]["role"] == "assistant"
-        assert second_call_messages[1]["content"] == round1_response.content
+        assert second_call_messages[1]["content"] is round1_response.content
         # Message 3: tool results
         assert second_call_messages[2]["role"] == "user"
         assert second_call_messages[2]["content"][0]["type"] == "tool_result"
 
-    @patch("ai_generator.anthropic.Anthropic")
-    def test_mixed_tool_use_different_tools_each_round(self, mock_anthropic_class):
+    def test_mixed_tool_use_different_tools_each_round(self, anthropic_mock, generator):
         """Test using different tools in each round"""
-        mock_client = Mock()
-        mock_anthropic_class.return_value = mock_client
+        _, mock_client = anthropic_mock
 
         # Round 1: use outline tool
-        round1_response = Mock()
-        round1_response.stop_reason = "tool_use"
-        outline_tool = Mock()
-        outline_tool.type = "tool_use"
-        outline_tool.name = "get_course_outline"
-        outline_tool.id = "id_1"
-        outline_tool.input = {"course_name": "Test"}
-        round1_response.content = [outline_tool]
+        round1_response = _tool_use(
+            "get_course_outline", "id_1", {"course_name": "Test"}
+        )
 
         # Round 2: use search tool
-        round2_response = Mock()
-        round2_response.stop_reason = "tool_use"
-        search_tool = Mock()
-        search_tool.type = "tool_use"
-        search_tool.name = "search_course_content"
-        search_tool.id = "id_2"
-        search_tool.input = {"query": "test"}
-        round2_response.content = [search_tool]
+        round2_response = _tool_use("search_course_content", "id_2", {"query": "test"})
 
         # Final response
-        final_response = Mock()
-        final_response.stop_reason = "end_turn"
-        final_response.content = [Mock(text="Combined result")]
+        final_response = _text("Combined result")
 
         mock_client.messages.create.side_effect = [
             round1_response,
@@ -522,142 +716,115 @@ class TestSequentialToolCalling:
             final_response,
         ]
 
-        mock_tool_manager = Mock()
-        mock_tool_manager.execute_tool.side_effect = ["Outline result", "Search result"]
+        tool_manager = FakeToolManager("Outline result", "Search result")
 
-        generator = AIGenerator(api_key="test-key", model="test-model")
-        result = generator.generate_response(
+        result, _ = generator.generate_response(
             query="complex query",
-            tools=[{"name": "get_course_outline"}, {"name": "search_course_content"}],
-            tool_manager=mock_tool_manager,
+            tools=_TOOLS_BOTH,
+            tool_manager=tool_manager,
         )
 
         # Verify both tools were called
         assert result == "Combined result"
-        assert mock_tool_manager.execute_tool.call_count == 2
-        calls = mock_tool_manager.execute_tool.call_args_list
-        assert calls[0][0][0] == "get_course_outline"
-        assert calls[1][0][0] == "search_course_content"
-
-    @patch("ai_generator.anthropic.Anthropic")
-    def test_early_termination_before_max_rounds(self, mock_anthropic_class):
-        """Test that execution stops when Claude returns end_turn before max rounds"""
-        mock_client = Mock()
-        mock_anthropic_class.return_value = mock_client
-
-        # Round 1: tool use
-        round1_response = Mock()
-        round1_response.stop_reason = "tool_use"
-        tool = Mock(type="tool_use", name="test_tool", id="id_1", input={})
-        round1_response.content = [tool]
+        assert len(tool_manager.calls) == 2
+        assert [name for name, _ in tool_manager.calls] == [
+            "get_course_outline",
+            "search_course_content",
+        ]
 
-        # Round 2: end_turn (before hitting MAX_TOOL_ROUNDS)
-        round2_response = Mock()
-        round2_response.stop_reason = "end_turn"
-        round2_response.content = [Mock(text="Early finish")]
+    def test_greedy_return_skips_redundant_search(self, anthropic_mock):
+        """Test that greedy_return answers without running a confirmatory search"""
+        _, mock_client = anthropic_mock
 
-        mock_client.messages.create.side_effect = [round1_response, round2_response]
+        answer = "A" * GREEDY_RETURN_MIN_CHARS
+        response = _tool_use("search_course_content", "tool_1", {"query": "q"}, answer)
+        mock_client.messages.create.return_value = response
 
-        mock_tool_manager = Mock()
-        mock_tool_manager.execute_tool.return_value = "Result"
+        tool_manager = FakeToolManager()
 
-        generator = AIGenerator(api_key="test-key", model="test-model")
-        result = generator.generate_response(
-            query="query", tools=[{"name": "test_tool"}], tool_manager=mock_tool_manager
+        generator = AIGenerator(
+            api_key="test-key", model="test-model", greedy_return=True
+        )
+        result, _ = generator.generate_response(
+            query="query",
+            tools=_TOOL_SEARCH,
+            tool_manager=tool_manager,
         )
 
-        # Should stop after 2 API calls (not MAX_TOOL_ROUNDS + 1)
-        assert result == "Early finish"
-        assert mock_client.messages.create.call_count == 2
-        assert mock_tool_manager.execute_tool.call_count == 1
+        assert result == answer
+        assert mock_client.messages.create.call_count == 1
+        assert tool_manager.calls == []
 
-    @patch("ai_generator.anthropic.Anthropic")
-    def test_tool_execution_order_preserved(self, mock_anthropic_class):
-        """Test that tools execute in correct order across rounds"""
-        mock_client = Mock()
-        mock_anthropic_class.return_value = mock_client
+    def test_greedy_return_runs_other_tools(self, anthropic_mock):
+        """Test that greedy_return still executes tools that are not searches"""
+        _, mock_client = anthropic_mock
 
-        # Round 1: tool use
-        round1_response = Mock()
-        round1_response.stop_reason = "tool_use"
-        tool1 = Mock()
-        tool1.type = "tool_use"
-        tool1.name = "first_tool"
-        tool1.id = "id_1"
-        tool1.input = {"order": 1}
-        round1_response.content = [tool1]
-
-        # Round 2: tool use
-        round2_response = Mock()
-        round2_response.stop_reason = "tool_use"
-        tool2 = Mock()
-        tool2.type = "tool_use"
-        tool2.name = "second_tool"
-        tool2.id = "id_2"
-        tool2.input = {"order": 2}
-        round2_response.content = [tool2]
-
-        # Final
-        final_response = Mock()
-        final_response.stop_reason = "end_turn"
-        final_response.content = [Mock(text="Done")]
+        tool_response = _tool_use(
+            "get_course_outline", "tool_1", {"course_name": "X"}, "A" * 500
+        )
 
-        mock_client.messages.create.side_effect = [
-            round1_response,
-            round2_response,
-            final_response,
-        ]
+        final_response = _text("Outline answer")
+        mock_client.messages.create.side_effect = [tool_response, final_response]
 
-        mock_tool_manager = Mock()
-        execution_order = []
+        tool_manager = FakeToolManager("Outline")
 
-        def track_execution(tool_name, **kwargs):
-            execution_order.append((tool_name, kwargs))
-            return f"Result from {tool_name}"
+        generator = AIGenerator(
+            api_key="test-key", model="test-model", greedy_return=True
+        )
+        result, _ = generator.generate_response(
+            query="query",
+            tools=_TOOL_OUTLINE,
+            tool_manager=tool_manager,
+        )
 
-        mock_tool_manager.execute_tool.side_effect = track_execution
+        assert result == "Outline answer"
+        assert mock_client.messages.create.call_count == 2
+        assert tool_manager.calls == [("get_course_outline", {"course_name": "X"})]
 
-        generator = AIGenerator(api_key="test-key", model="test-model")
-        result = generator.generate_response(
-            query="query",
-            tools=[{"name": "first_tool"}, {"name": "second_tool"}],
-            tool_manager=mock_tool_manager,
+    def test_multiple_tool_calls_in_one_round_run_concurrently(
+        self, anthropic_mock, generator
+    ):
+        """Test that independent tool calls in one response overlap in time"""
+        _, mock_client = anthropic_mock
+
+        # One response requesting two outlines at once
+        tool_response = SimpleNamespace(
+            stop_reason="tool_use",
+            content=[
+                _tool_block("get_course_outline", block_id, {"course_name": course})
+                for block_id, course in [("id_a", "Course A"), ("id_b", "Course B")]
+            ],
         )
 
-        # Verify execution order
-        assert len(execution_order) == 2
-        assert execution_order[0][0] == "first_tool"
-        assert execution_order[0][1] == {"order": 1}
-        assert execution_order[1][0] == "second_tool"
-        assert execution_order[1][1] == {"order": 2}
+        final_response = _text("Both outlines")
 
-    @patch("ai_generator.anthropic.Anthropic")
-    def test_no_tool_manager_stops_execution(self, mock_anthropic_class):
-        """Test that tool_use without tool_manager returns immediately"""
-        mock_client = Mock()
-        mock_anthropic_class.return_value = mock_client
+        mock_client.messages.create.side_effect = [tool_response, final_response]
 
-        # Response with tool use
-        tool_response = Mock()
-        tool_response.stop_reason = "tool_use"
-        tool_block = Mock(type="tool_use", name="test_tool", id="id", input={})
-        tool_response.content = [tool_block]
+        # Each call waits for the other, so a sequential loop would time out
+        barrier = threading.Barrier(2, timeout=5)
 
-        mock_client.messages.create.return_value = tool_response
+        def execute_tool(tool_name, course_name):
+            barrier.wait()
+            # Let the second call finish first; results must keep request order
+            if course_name == "Course A":
+                time.sleep(0.05)
+            return f"Outline of {course_name}", [SourceLink(text=course_name)]
 
-        generator = AIGenerator(api_key="test-key", model="test-model")
-        result = generator.generate_response(
-            query="query",
-            tools=[{"name": "test_tool"}],
-            tool_manager=None,  # No tool manager
+        tool_manager = SimpleNamespace(execute_tool=execute_tool)
+
+        result, sources = generator.generate_response(
+            query="Compare A and B",
+            tools=_TOOL_OUTLINE,
+            tool_manager=tool_manager,
         )
 
-        # Should return the text from the tool block (or empty if no text block)
-        # Since content only has tool_use, accessing content[0].text will fail
-        # So the method should handle this gracefully or we accept the behavior
-        # Actually, looking at the code, it will try response.content[0].text
-        # This will fail because content[0] is a tool_use block, not a text block
-        # Let's adjust: when tool_use happens but no tool_manager, it should handle gracefully
-        # For now, this test documents the current behavior
-        # We may need to update the implementation to handle this edge case
-        assert mock_client.messages.create.call_count == 1
+        assert result == "Both outlines"
+        # Sources are those of the last call in request order, not completion
+        assert sources == [SourceLink(text="Course B")]
+        second_kwargs = mock_client.messages.create.call_args_list[1].kwargs
+        tool_results = second_kwargs["messages"][2]["content"]
+        assert [r["tool_use_id"] for r in tool_results] == ["id_a", "id_b"]
+        assert [r["content"] for r in tool_results] == [
+            "Outline of Course A",
+            "Outline of Course B",
+        ]
@@ -1,14 +1,19 @@
 """API endpoint tests for the RAG system"""
+import asyncio
+
+import orjson
 import pytest
-from fastapi.testclient import TestClient
-from unittest.mock import Mock
+
+# Generic query body serialized once and reused by every POST that sends it
+_QUERY_BODY = orjson.dumps({"query": "test query"})
+_JSON_HEADERS = {"Content-Type": "application/json"}
 
 
 @pytest.mark.api
 class TestQueryEndpoint:
     """Tests for /api/query endpoint"""
 
-    def test_query_without_session_id(self, test_client, mock_rag_system):
+    def test_query_without_session_id(self, test_client, mock_rag_system, json_of):
         """Test query endpoint without session ID creates new session"""
         response = test_client.post(
             "/api/query",
@@ -17,7 +22,7 @@ class TestQueryEndpoint:
 
         # Verify response
         assert response.status_code == 200
-        data = response.json()
+        data = json_of(response)
         assert "answer" in data
         assert "sources" in data
         assert "session_id" in data
@@ -30,7 +35,7 @@ class TestQueryEndpoint:
         mock_rag_system.session_manager.create_session.assert_called_once()
         mock_rag_system.query.assert_called_once()
 
-    def test_query_with_session_id(self, test_client, mock_rag_system):
+    def test_query_with_session_id(self, test_client, mock_rag_system, json_of):
         """Test query endpoint with existing session ID"""
         response = test_client.post(
             "/api/query",
@@ -42,7 +47,7 @@ class TestQueryEndpoint:
 
         # Verify response
         assert response.status_code == 200
-        data = response.json()
+        data = json_of(response)
         assert data["session_id"] == "session_123"
 
         # Verify RAG system was called with session ID
@@ -71,15 +76,14 @@ class TestQueryEndpoint:
         # Should return 422 Unprocessable Entity for missing required field
         assert response.status_code == 422
 
-    def test_query_response_structure(self, test_client):
+    def test_query_response_structure(self, test_client, json_of):
         """Test query endpoint returns correct response structure"""
         response = test_client.post(
-            "/api/query",
-            json={"query": "test query"}
+            "/api/query", content=_QUERY_BODY, headers=_JSON_HEADERS
         )
 
         assert response.status_code == 200
-        data = response.json()
+        data = json_of(response)
 
         # Verify all required fields
         assert isinstance(data["answer"], str)
@@ -96,7 +100,7 @@ class TestQueryEndpoint:
         """Test query endpoint handles invalid JSON"""
         response = test_client.post(
             "/api/query",
-            data="invalid json",
+            content="invalid json",
             headers={"Content-Type": "application/json"}
         )
 
@@ -113,20 +117,65 @@ class TestQueryEndpoint:
         assert response.status_code == 200
         # Verify the query was passed correctly
         mock_rag_system.query.assert_called_once()
-        call_args = mock_rag_system.query.call_args[0]
-        assert special_query in call_args
+        args = mock_rag_system.query.call_args.args
+        assert special_query in args
+
+
+@pytest.mark.api
+class TestQueryStreamEndpoint:
+    """Tests for /api/query/stream endpoint"""
+
+    def test_stream_emits_text_chunks_then_sources(self, test_client, mock_rag_system):
+        """Test the stream sends one NDJSON text event per chunk, then a done event"""
+        response = test_client.post(
+            "/api/query/stream",
+            json={"query": "What is testing?", "session_id": "session_123"}
+        )
+
+        assert response.status_code == 200
+        assert response.headers["content-type"] == "application/x-ndjson"
+        events = [orjson.loads(line) for line in response.content.splitlines()]
+        assert events == [
+            {"type": "text", "text": "This is a test "},
+            {"type": "text", "text": "response."},
+            {
+                "type": "done",
+                "sources": [
+                    {
+                        "text": "Test Course - Lesson 0",
+                        "link": "https://example.com/lesson-0",
+                    }
+                ],
+                "session_id": "session_123",
+            },
+        ]
+        mock_rag_system.query_stream.assert_called_once_with(
+            "What is testing?", "session_123"
+        )
+
+    def test_stream_reports_errors_as_event(self, test_client, mock_rag_system):
+        """Test a failure mid-stream ends the stream with an error event"""
+        mock_rag_system.query_stream.side_effect = Exception("Stream failed")
+
+        response = test_client.post(
+            "/api/query/stream", content=_QUERY_BODY, headers=_JSON_HEADERS
+        )
+
+        assert response.status_code == 200
+        events = [orjson.loads(line) for line in response.content.splitlines()]
+        assert events == [{"type": "error", "detail": "Stream failed"}]
 
 
 @pytest.mark.api
 class TestCoursesEndpoint:
     """Tests for /api/courses endpoint"""
 
-    def test_get_courses_returns_stats(self, test_client, mock_rag_system):
+    def test_get_courses_returns_stats(self, test_client, mock_rag_system, json_of):
         """Test courses endpoint returns course statistics"""
         response = test_client.get("/api/courses")
 
         assert response.status_code == 200
-        data = response.json()
+        data = json_of(response)
         assert "total_courses" in data
         assert "course_titles" in data
         assert data["total_courses"] == 2
@@ -135,12 +184,12 @@ class TestCoursesEndpoint:
         # Verify RAG system was called
         mock_rag_system.get_course_analytics.assert_called_once()
 
-    def test_get_courses_response_structure(self, test_client):
+    def test_get_courses_response_structure(self, test_client, json_of):
         """Test courses endpoint returns correct structure"""
         response = test_client.get("/api/courses")
 
         assert response.status_code == 200
-        data = response.json()
+        data = json_of(response)
         assert isinstance(data["total_courses"], int)
         assert isinstance(data["course_titles"], list)
         assert all(isinstance(title, str) for title in data["course_titles"])
@@ -160,12 +209,12 @@ class TestCoursesEndpoint:
 class TestSessionEndpoint:
     """Tests for /api/session/{session_id} endpoint"""
 
-    def test_clear_session_success(self, test_client, mock_rag_system):
+    def test_clear_session_success(self, test_client, mock_rag_system, json_of):
         """Test clearing a session"""
         response = test_client.delete("/api/session/session_123")
 
         assert response.status_code == 200
-        data = response.json()
+        data = json_of(response)
         assert data["status"] == "success"
         assert "session_123" in data["message"]
 
@@ -198,8 +247,7 @@ class TestErrorHandling:
         mock_rag_system.query.side_effect = Exception("Database connection failed")
 
         response = test_client.post(
-            "/api/query",
-            json={"query": "test query"}
+            "/api/query", content=_QUERY_BODY, headers=_JSON_HEADERS
         )
 
         # Should return 500 Internal Server Error
@@ -229,39 +277,43 @@ class TestErrorHandling:
         assert response.status_code == 405  # Method Not Allowed
 
 
+@pytest.fixture(scope="class")
+def preflight_response(shared_test_client):
+    """One CORS preflight request shared by every header check in a class"""
+    return shared_test_client.options(
+        "/api/query",
+        headers={
+            "Origin": "http://localhost:3000",
+            "Access-Control-Request-Method": "POST",
+        }
+    )
+
+
 @pytest.mark.api
+@pytest.mark.skipif(
+    "not config.getoption('--full-api')", reason="CORS tests need --full-api"
+)
 class TestCORSConfiguration:
     """Tests for CORS middleware configuration"""
 
-    def test_cors_headers_present(self, test_client):
-        """Test that CORS headers are present in responses"""
-        response = test_client.options(
-            "/api/query",
-            headers={
-                "Origin": "http://localhost:3000",
-                "Access-Control-Request-Method": "POST",
-            }
-        )
-
-        # CORS headers should be present
-        assert "access-control-allow-origin" in response.headers
-        assert "access-control-allow-methods" in response.headers
-
-    def test_cors_allows_credentials(self, test_client):
-        """Test that CORS allows credentials"""
-        response = test_client.get(
-            "/api/courses",
-            headers={"Origin": "http://localhost:3000"}
-        )
-
-        assert "access-control-allow-credentials" in response.headers
+    @pytest.mark.parametrize(
+        "header",
+        [
+            "access-control-allow-origin",
+            "access-control-allow-methods",
+            "access-control-allow-credentials",
+        ]
+    )
+    def test_cors_header_present(self, preflight_response, header):
+        """Test that the preflight response carries each expected CORS header"""
+        assert header in preflight_response.headers
 
 
 @pytest.mark.api
 class TestEndpointIntegration:
     """Integration tests for API endpoints working together"""
 
-    def test_create_session_and_query_flow(self, test_client, mock_rag_system):
+    def test_create_session_and_query_flow(self, test_client, mock_rag_system, json_of):
         """Test the flow of creating a session and making queries"""
         # First query creates session
         response1 = test_client.post(
@@ -269,7 +321,7 @@ class TestEndpointIntegration:
             json={"query": "First question"}
         )
         assert response1.status_code == 200
-        session_id = response1.json()["session_id"]
+        session_id = json_of(response1)["session_id"]
 
         # Second query uses same session
         response2 = test_client.post(
@@ -277,19 +329,18 @@ class TestEndpointIntegration:
             json={"query": "Follow-up question", "session_id": session_id}
         )
         assert response2.status_code == 200
-        assert response2.json()["session_id"] == session_id
+        assert json_of(response2)["session_id"] == session_id
 
         # Verify both queries were made
         assert mock_rag_system.query.call_count == 2
 
-    def test_query_then_clear_session(self, test_client, mock_rag_system):
+    def test_query_then_clear_session(self, test_client, mock_rag_system, json_of):
         """Test querying then clearing the session"""
         # Create session with query
         response1 = test_client.post(
-            "/api/query",
-            json={"query": "Test query"}
+            "/api/query", content=_QUERY_BODY, headers=_JSON_HEADERS
         )
-        session_id = response1.json()["session_id"]
+        session_id = json_of(response1)["session_id"]
 
         # Clear the session
         response2 = test_client.delete(f"/api/session/{session_id}")
@@ -298,22 +349,24 @@ class TestEndpointIntegration:
         # Verify session was cleared
         mock_rag_system.session_manager.clear_session.assert_called_once_with(session_id)
 
-    def test_multiple_concurrent_sessions(self, test_client, mock_rag_system):
+    @pytest.mark.anyio
+    async def test_multiple_concurrent_sessions(
+        self, async_client, mock_rag_system, next_session_id, json_of
+    ):
         """Test that multiple sessions can exist independently"""
-        # Configure mock to return different session IDs
-        session_ids = ["session_1", "session_2", "session_3"]
-        mock_rag_system.session_manager.create_session.side_effect = session_ids
-
-        # Create multiple sessions
-        responses = []
-        for i in range(3):
-            response = test_client.post(
-                "/api/query",
-                json={"query": f"Query {i}"}
-            )
-            responses.append(response)
+        # Configure mock to return a fresh session ID per call
+        mock_rag_system.session_manager.create_session.side_effect = next_session_id
+
+        # Create multiple sessions with overlapping requests
+        responses = await asyncio.gather(
+            *[
+                async_client.post("/api/query", json={"query": f"Query {i}"})
+                for i in range(3)
+            ]
+        )
 
         # Verify all succeeded and have different session IDs
         assert all(r.status_code == 200 for r in responses)
-        returned_session_ids = [r.json()["session_id"] for r in responses]
-        assert returned_session_ids == session_ids
+        returned_session_ids = [json_of(r)["session_id"] for r in responses]
+        assert len(set(returned_session_ids)) == 3
+        assert all(sid.startswith("session_") for sid in returned_session_ids)
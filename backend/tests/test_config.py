@@ -81,3 +81,11 @@ class TestConfigValidation:
         assert (
             "claude" in config.ANTHROPIC_MODEL.lower()
         ), f"ANTHROPIC_MODEL should contain 'claude', got {config.ANTHROPIC_MODEL}"
+
+    def test_router_model_is_valid(self):
+        """ANTHROPIC_ROUTER_MODEL should be a valid Claude model"""
+        assert config.ANTHROPIC_ROUTER_MODEL, "ANTHROPIC_ROUTER_MODEL must be set"
+        assert "claude" in config.ANTHROPIC_ROUTER_MODEL.lower(), (
+            "ANTHROPIC_ROUTER_MODEL should contain 'claude', "
+            f"got {config.ANTHROPIC_ROUTER_MODEL}"
+        )
@@ -1,298 +1,182 @@
 """Integration tests for RAG system"""
 
-from unittest.mock import MagicMock, Mock, patch
+from dataclasses import replace
+from unittest.mock import Mock
 
 import pytest
 from models import SourceLink
 from rag_system import RAGSystem
+from session_manager import SessionManager
+from streaming import drain
 
+QUERY = "What is testing?"
 
-class TestRAGSystemIntegration:
-    """Integration tests for RAGSystem with mocked components"""
+HISTORY = [
+    {"role": "user", "content": "Previous question"},
+    {"role": "assistant", "content": "Previous answer"},
+]
 
-    @patch("rag_system.VectorStore")
-    @patch("rag_system.AIGenerator")
-    @patch("rag_system.SessionManager")
-    @patch("rag_system.DocumentProcessor")
-    def test_query_without_session(
-        self,
-        mock_doc_processor,
-        mock_session_manager,
-        mock_ai_generator_class,
-        mock_vector_store_class,
-        test_config,
-    ):
-        """Test query() without session ID"""
-        # Setup mocks
-        mock_vector_store = Mock()
-        mock_vector_store_class.return_value = mock_vector_store
 
-        mock_ai_gen = Mock()
-        mock_ai_gen.generate_response.return_value = "AI response"
-        mock_ai_generator_class.return_value = mock_ai_gen
+def _assert_response_without_history(rag_mocks, rag_system, response, sources):
+    """The AI answer is returned and no history is looked up"""
+    kwargs = rag_mocks.ai_generator.generate_response.call_args.kwargs
+    assert response == "AI response"
+    assert kwargs["conversation_history"] is None
+    rag_mocks.session_manager.get_conversation_history.assert_not_called()
 
-        mock_session = Mock()
-        mock_session_manager.return_value = mock_session
 
-        # Create RAG system
-        rag_system = RAGSystem(test_config)
+def _assert_history_used(rag_mocks, rag_system, response, sources):
+    """The session's history is retrieved and passed to the AI generator"""
+    rag_mocks.session_manager.get_conversation_history.assert_called_once_with(
+        "session_1"
+    )
+    kwargs = rag_mocks.ai_generator.generate_response.call_args.kwargs
+    assert kwargs["conversation_history"] == HISTORY
 
-        # Mock tool manager
-        rag_system.tool_manager.get_last_sources = Mock(return_value=[])
-        rag_system.tool_manager.reset_sources = Mock()
-
-        # Execute query
-        response, sources = rag_system.query("What is testing?")
-
-        # Verify AI generator was called
-        assert mock_ai_gen.generate_response.called
-        assert response == "AI response"
-
-    @patch("rag_system.VectorStore")
-    @patch("rag_system.AIGenerator")
-    @patch("rag_system.SessionManager")
-    @patch("rag_system.DocumentProcessor")
-    def test_query_with_session(
-        self,
-        mock_doc_processor,
-        mock_session_manager_class,
-        mock_ai_generator_class,
-        mock_vector_store_class,
-        test_config,
-    ):
-        """Test query() with session ID includes conversation history"""
-        # Setup mocks
-        mock_vector_store = Mock()
-        mock_vector_store_class.return_value = mock_vector_store
 
-        mock_ai_gen = Mock()
-        mock_ai_gen.generate_response.return_value = "AI response"
-        mock_ai_generator_class.return_value = mock_ai_gen
+def _assert_tools_passed(rag_mocks, rag_system, response, sources):
+    """Tool definitions and the tool manager are passed to the AI generator"""
+    kwargs = rag_mocks.ai_generator.generate_response.call_args.kwargs
+    assert kwargs["tool_manager"] is rag_system.tool_manager
+    tools = kwargs["tools"]
+    assert isinstance(tools, list)
+    assert len(tools) >= 1  # At least search tool
 
-        mock_session_manager = Mock()
-        mock_session_manager.get_conversation_history.return_value = (
-            "Previous: conversation"
-        )
-        mock_session_manager_class.return_value = mock_session_manager
 
-        # Create RAG system
-        rag_system = RAGSystem(test_config)
-        rag_system.tool_manager.get_last_sources = Mock(return_value=[])
-        rag_system.tool_manager.reset_sources = Mock()
+def _assert_sources_returned(rag_mocks, rag_system, response, sources):
+    """The sources returned by the AI generator are passed straight through"""
+    assert sources is rag_mocks.ai_generator.generate_response.return_value[1]
 
-        # Execute query with session
-        response, sources = rag_system.query("What is testing?", session_id="session_1")
 
-        # Verify history was retrieved
-        mock_session_manager.get_conversation_history.assert_called_once_with(
-            "session_1"
-        )
+def _assert_history_updated(rag_mocks, rag_system, response, sources):
+    """The exchange is recorded in the session history"""
+    rag_mocks.session_manager.add_exchange.assert_called_once_with(
+        "session_1", QUERY, "AI response"
+    )
 
-        # Verify AI generator was called with history
-        call_args = mock_ai_gen.generate_response.call_args
-        assert call_args[1]["conversation_history"] == "Previous: conversation"
-
-    @patch("rag_system.VectorStore")
-    @patch("rag_system.AIGenerator")
-    @patch("rag_system.SessionManager")
-    @patch("rag_system.DocumentProcessor")
-    def test_query_passes_tools_to_ai_generator(
-        self,
-        mock_doc_processor,
-        mock_session_manager,
-        mock_ai_generator_class,
-        mock_vector_store_class,
-        test_config,
-    ):
-        """Test that query() passes tool definitions to AI generator"""
-        # Setup mocks
-        mock_vector_store = Mock()
-        mock_vector_store_class.return_value = mock_vector_store
 
-        mock_ai_gen = Mock()
-        mock_ai_gen.generate_response.return_value = "AI response"
-        mock_ai_generator_class.return_value = mock_ai_gen
+def _assert_prompt_formatted(rag_mocks, rag_system, response, sources):
+    """The prompt wraps the user query; the bare query is passed for caching"""
+    kwargs = rag_mocks.ai_generator.generate_response.call_args.kwargs
+    prompt = kwargs["query"]
+    assert QUERY in prompt
+    assert "course materials" in prompt.lower()
+    assert kwargs["user_query"] == QUERY
 
-        # Create RAG system
-        rag_system = RAGSystem(test_config)
-        rag_system.tool_manager.get_last_sources = Mock(return_value=[])
-        rag_system.tool_manager.reset_sources = Mock()
-
-        # Execute query
-        response, sources = rag_system.query("What is testing?")
-
-        # Verify tools were passed
-        call_args = mock_ai_gen.generate_response.call_args
-        assert "tools" in call_args[1]
-        assert "tool_manager" in call_args[1]
-
-        # Verify tools are the tool definitions
-        tools = call_args[1]["tools"]
-        assert isinstance(tools, list)
-        assert len(tools) >= 1  # At least search tool
-
-    @patch("rag_system.VectorStore")
-    @patch("rag_system.AIGenerator")
-    @patch("rag_system.SessionManager")
-    @patch("rag_system.DocumentProcessor")
-    def test_query_retrieves_and_resets_sources(
-        self,
-        mock_doc_processor,
-        mock_session_manager,
-        mock_ai_generator_class,
-        mock_vector_store_class,
-        test_config,
-    ):
-        """Test that query() retrieves sources and then resets them"""
-        # Setup mocks
-        mock_vector_store = Mock()
-        mock_vector_store_class.return_value = mock_vector_store
 
-        mock_ai_gen = Mock()
-        mock_ai_gen.generate_response.return_value = "AI response"
-        mock_ai_generator_class.return_value = mock_ai_gen
+class TestRAGSystemIntegration:
+    """Integration tests for RAGSystem with mocked components"""
 
-        # Create RAG system
-        rag_system = RAGSystem(test_config)
+    @pytest.mark.parametrize(
+        "session_id,check",
+        [
+            (None, _assert_response_without_history),
+            ("session_1", _assert_history_used),
+            (None, _assert_tools_passed),
+            (None, _assert_sources_returned),
+            ("session_1", _assert_history_updated),
+            (None, _assert_prompt_formatted),
+        ],
+        ids=[
+            "without-session",
+            "with-session",
+            "passes-tools",
+            "returns-sources",
+            "updates-conversation-history",
+            "formats-prompt",
+        ],
+    )
+    def test_query(self, rag_mocks, rag_system, sample_sources, session_id, check):
+        """Test one query() call against the scenario's assertions"""
+        rag_mocks.session_manager.get_conversation_history.return_value = HISTORY
+        rag_mocks.ai_generator.generate_response.return_value = (
+            "AI response",
+            sample_sources,
+        )
+
+        response, sources = rag_system.query(QUERY, session_id=session_id)
+
+        check(rag_mocks, rag_system, response, sources)
 
-        # Mock tool manager with sources
-        test_sources = [
-            SourceLink(
-                text="Test Course - Lesson 0", link="http://example.com/lesson-0"
-            )
-        ]
-        rag_system.tool_manager.get_last_sources = Mock(return_value=test_sources)
-        rag_system.tool_manager.reset_sources = Mock()
-
-        # Execute query
-        response, sources = rag_system.query("What is testing?")
-
-        # Verify sources were retrieved and reset
-        rag_system.tool_manager.get_last_sources.assert_called_once()
-        rag_system.tool_manager.reset_sources.assert_called_once()
-
-        # Verify sources are returned
-        assert sources == test_sources
-
-    @patch("rag_system.VectorStore")
-    @patch("rag_system.AIGenerator")
-    @patch("rag_system.SessionManager")
-    @patch("rag_system.DocumentProcessor")
-    def test_query_updates_conversation_history(
-        self,
-        mock_doc_processor,
-        mock_session_manager_class,
-        mock_ai_generator_class,
-        mock_vector_store_class,
-        test_config,
+    def test_query_stream_yields_chunks_and_updates_history(
+        self, rag_mocks, rag_system
     ):
-        """Test that query() updates conversation history after response"""
-        # Setup mocks
-        mock_vector_store = Mock()
-        mock_vector_store_class.return_value = mock_vector_store
+        """Test that query_stream() forwards chunks and records the full answer"""
+        test_sources = [SourceLink(text="Test Course - Lesson 1", link=None)]
 
-        mock_ai_gen = Mock()
-        mock_ai_gen.generate_response.return_value = "AI response"
-        mock_ai_generator_class.return_value = mock_ai_gen
+        def response_stream(**kwargs):
+            yield "AI "
+            yield "response"
+            return test_sources
 
-        mock_session_manager = Mock()
-        mock_session_manager_class.return_value = mock_session_manager
+        mock_ai_gen = rag_mocks.ai_generator
+        mock_ai_gen.generate_response_stream.side_effect = response_stream
 
-        # Create RAG system
-        rag_system = RAGSystem(test_config)
-        rag_system.tool_manager.get_last_sources = Mock(return_value=[])
-        rag_system.tool_manager.reset_sources = Mock()
+        mock_session_manager = rag_mocks.session_manager
 
-        # Execute query with session
-        query_text = "What is testing?"
-        response, sources = rag_system.query(query_text, session_id="session_1")
+        chunks, sources = drain(
+            rag_system.query_stream("What is testing?", "session_1")
+        )
 
-        # Verify history was updated
+        assert chunks == ["AI ", "response"]
         mock_session_manager.add_exchange.assert_called_once_with(
-            "session_1", query_text, "AI response"
+            "session_1", "What is testing?", "AI response"
         )
+        # Sources are the stream's return value
+        assert sources is test_sources
 
-    @patch("rag_system.VectorStore")
-    @patch("rag_system.AIGenerator")
-    @patch("rag_system.SessionManager")
-    @patch("rag_system.DocumentProcessor")
-    def test_query_formats_prompt_correctly(
-        self,
-        mock_doc_processor,
-        mock_session_manager,
-        mock_ai_generator_class,
-        mock_vector_store_class,
-        test_config,
-    ):
-        """Test that query() formats the prompt correctly"""
-        # Setup mocks
-        mock_vector_store = Mock()
-        mock_vector_store_class.return_value = mock_vector_store
+    @pytest.mark.parametrize("enabled", [False, True])
+    def test_greedy_return_follows_config(self, rag_patch, test_config, enabled):
+        """Test that GREEDY_RETURN is passed through to the AI generator"""
+        import rag_system as rag_system_module
 
-        mock_ai_gen = Mock()
-        mock_ai_gen.generate_response.return_value = "AI response"
-        mock_ai_generator_class.return_value = mock_ai_gen
+        RAGSystem(replace(test_config, GREEDY_RETURN=enabled))
 
-        # Create RAG system
-        rag_system = RAGSystem(test_config)
-        rag_system.tool_manager.get_last_sources = Mock(return_value=[])
-        rag_system.tool_manager.reset_sources = Mock()
+        kwargs = rag_system_module.AIGenerator.call_args.kwargs
+        assert kwargs["greedy_return"] is enabled
+
+    @pytest.mark.parametrize("streamed", [False, True], ids=["query", "stream"])
+    def test_empty_answer_not_recorded(
+        self, monkeypatch, rag_mocks, rag_system, streamed
+    ):
+        """Test that an empty answer leaves the session usable for the next turn"""
+        monkeypatch.setattr(rag_system, "session_manager", SessionManager(2))
+        mock_ai_gen = rag_mocks.ai_generator
+        mock_ai_gen.generate_response.return_value = ("", [])
+        mock_ai_gen.generate_response_stream.side_effect = lambda **kwargs: iter(())
 
-        # Execute query
-        user_query = "What is testing?"
-        response, sources = rag_system.query(user_query)
+        if streamed:
+            list(rag_system.query_stream(QUERY, "session_1"))
+        else:
+            rag_system.query(QUERY, "session_1")
+        rag_system.query("Follow-up", "session_1")
 
-        # Verify prompt includes user query
-        call_args = mock_ai_gen.generate_response.call_args
-        prompt = call_args[1]["query"]
-        assert user_query in prompt
-        assert "course materials" in prompt.lower()
+        # No empty assistant turn is sent back to the API
+        kwargs = mock_ai_gen.generate_response.call_args.kwargs
+        assert kwargs["conversation_history"] is None
 
 
+@pytest.mark.slow
 class TestRAGSystemToolIntegration:
     """Test RAG system integration with real tools but mocked vector store"""
 
-    @patch("rag_system.VectorStore")
-    @patch("rag_system.DocumentProcessor")
-    def test_search_tool_registered(
-        self, mock_doc_processor, mock_vector_store_class, test_config
-    ):
+    def test_search_tool_registered(self, tool_rag_system):
         """Test that CourseSearchTool is registered"""
-        mock_vector_store = Mock()
-        mock_vector_store_class.return_value = mock_vector_store
-
-        rag_system = RAGSystem(test_config)
+        rag_system, _ = tool_rag_system
 
         # Verify search tool is registered
         assert "search_course_content" in rag_system.tool_manager.tools
 
-    @patch("rag_system.VectorStore")
-    @patch("rag_system.DocumentProcessor")
-    def test_outline_tool_registered(
-        self, mock_doc_processor, mock_vector_store_class, test_config
-    ):
+    def test_outline_tool_registered(self, tool_rag_system):
         """Test that CourseOutlineTool is registered"""
-        mock_vector_store = Mock()
-        mock_vector_store_class.return_value = mock_vector_store
-
-        rag_system = RAGSystem(test_config)
+        rag_system, _ = tool_rag_system
 
         # Verify outline tool is registered
         assert "get_course_outline" in rag_system.tool_manager.tools
 
-    @patch("rag_system.VectorStore")
-    @patch("rag_system.DocumentProcessor")
-    def test_tool_definitions_available(
-        self, mock_doc_processor, mock_vector_store_class, test_config
-    ):
+    def test_tool_definitions_available(self, tool_rag_system):
         """Test that tool definitions can be retrieved"""
-        mock_vector_store = Mock()
-        mock_vector_store_class.return_value = mock_vector_store
-
-        rag_system = RAGSystem(test_config)
-
-        # Get tool definitions
-        tool_defs = rag_system.tool_manager.get_tool_definitions()
+        _, tool_defs = tool_rag_system
 
         # Verify we have definitions
         assert isinstance(tool_defs, list)
@@ -303,33 +187,31 @@ class TestRAGSystemToolIntegration:
         assert "search_course_content" in tool_names
         assert "get_course_outline" in tool_names
 
-    @patch("rag_system.VectorStore")
-    @patch("rag_system.DocumentProcessor")
     def test_search_tool_execution_through_manager(
-        self,
-        mock_doc_processor,
-        mock_vector_store_class,
-        test_config,
-        sample_search_results,
+        self, monkeypatch, test_config, sample_search_results
     ):
         """Test executing search tool through tool manager"""
         # Setup mock vector store
         mock_vector_store = Mock()
         mock_vector_store.search.return_value = sample_search_results
-        mock_vector_store.get_lesson_link.return_value = "https://example.com/lesson"
-        mock_vector_store_class.return_value = mock_vector_store
+        mock_vector_store.get_lesson_links_batch.return_value = {}
+        monkeypatch.setattr(
+            "rag_system.VectorStore", Mock(return_value=mock_vector_store)
+        )
+        monkeypatch.setattr("rag_system.DocumentProcessor", Mock())
 
         # Create RAG system
         rag_system = RAGSystem(test_config)
 
         # Execute tool through manager
-        result = rag_system.tool_manager.execute_tool(
+        result, sources = rag_system.tool_manager.execute_tool(
             "search_course_content", query="test query"
         )
 
-        # Verify result is a string
+        # Verify result is a string, returned with its sources
         assert isinstance(result, str)
         assert len(result) > 0
+        assert len(sources) == 2
 
         # Verify search was called
         mock_vector_store.search.assert_called_once()
@@ -338,29 +220,10 @@ class TestRAGSystemToolIntegration:
 class TestRAGSystemErrorHandling:
     """Test RAG system error handling"""
 
-    @patch("rag_system.VectorStore")
-    @patch("rag_system.AIGenerator")
-    @patch("rag_system.SessionManager")
-    @patch("rag_system.DocumentProcessor")
-    def test_query_handles_ai_generator_exception(
-        self,
-        mock_doc_processor,
-        mock_session_manager,
-        mock_ai_generator_class,
-        mock_vector_store_class,
-        test_config,
-    ):
+    def test_query_handles_ai_generator_exception(self, rag_mocks, rag_system):
         """Test that query() propagates AI generator exceptions"""
-        # Setup mocks
-        mock_vector_store = Mock()
-        mock_vector_store_class.return_value = mock_vector_store
-
-        mock_ai_gen = Mock()
+        mock_ai_gen = rag_mocks.ai_generator
         mock_ai_gen.generate_response.side_effect = Exception("API Error")
-        mock_ai_generator_class.return_value = mock_ai_gen
-
-        # Create RAG system
-        rag_system = RAGSystem(test_config)
 
         # Query should raise exception
         with pytest.raises(Exception) as exc_info:
@@ -1,21 +1,77 @@
 """Tests for search tools functionality"""
 
-from unittest.mock import Mock
+from unittest.mock import patch
 
 import pytest
 from models import SourceLink
-from search_tools import CourseOutlineTool, CourseSearchTool, ToolManager
+from search_tools import (
+    CourseOutlineTool,
+    CourseSearchTool,
+    ToolManager,
+    _source_sort_key,
+)
 from vector_store import SearchResults
 
+# Chunk metadata in mixed course/lesson order, for the source sorting tests
+MIXED_METADATA = [
+    {"course_title": "B Course", "lesson_number": 2},
+    {"course_title": "A Course"},
+    {"course_title": "A Course", "lesson_number": 1},
+    {"course_title": "A Course", "lesson_number": 0},
+]
 
+
+def _assert_contains_all(text, *substrings):
+    """Assert every substring occurs in text, reporting the missing ones"""
+    missing = [s for s in substrings if s not in text]
+    assert not missing, f"{missing} not found in {text!r}"
+
+
+def _all_source_links(items):
+    """Whether every item is exactly a SourceLink, via one set of types"""
+    return {type(item) for item in items} <= {SourceLink}
+
+
+# Tools only hold the store, so each test class shares one instance of each;
+# _reset_store_mock restores the store's stubs between tests. Each class is
+# its own xdist group so one worker builds its tools once.
+@pytest.fixture(scope="class")
+def search_tool(shared_mock_vector_store):
+    """One CourseSearchTool over the session's mock store per test class"""
+    return CourseSearchTool(shared_mock_vector_store)
+
+
+@pytest.fixture(scope="class")
+def outline_tool(shared_mock_vector_store):
+    """One CourseOutlineTool over the session's mock store per test class"""
+    return CourseOutlineTool(shared_mock_vector_store)
+
+
+@pytest.fixture
+def registered_manager(request, search_tool, outline_tool):
+    """A fresh ToolManager with the tools named in request.param registered"""
+    tools = {"search": search_tool, "outline": outline_tool}
+    manager = ToolManager()
+    for name in request.param:
+        manager.register_tool(tools[name])
+    return manager
+
+
+@pytest.fixture(autouse=True)
+def _reset_store_mock(mock_vector_store):
+    """Start every test with the shared store mock at its defaults"""
+
+
+@pytest.mark.unit
+@pytest.mark.xdist_group("search_tool")
 class TestCourseSearchTool:
     """Tests for CourseSearchTool"""
 
-    def test_get_tool_definition(self, mock_vector_store):
+    def test_get_tool_definition(self, search_tool):
         """Test that tool definition is correctly structured"""
-        tool = CourseSearchTool(mock_vector_store)
-        definition = tool.get_tool_definition()
+        definition = search_tool.get_tool_definition()
 
+        assert search_tool.get_tool_definition() is definition
         assert definition["name"] == "search_course_content"
         assert "description" in definition
         assert "input_schema" in definition
@@ -23,77 +79,59 @@ class TestCourseSearchTool:
         assert "query" in definition["input_schema"]["properties"]
         assert "query" in definition["input_schema"]["required"]
 
-    def test_execute_with_valid_query(self, mock_vector_store, sample_search_results):
-        """Test execute() returns formatted results for valid query"""
-        tool = CourseSearchTool(mock_vector_store)
-        mock_vector_store.search.return_value = sample_search_results
-
-        result = tool.execute(query="test query")
-
-        # Should return formatted string with content
+    # Pure forwarding checks run against a plain fake store rather than a Mock
+    @pytest.mark.parametrize(
+        "kwargs,expected_call",
+        [
+            ({}, ("test query", None, None)),
+            ({"course_name": "Test Course"}, ("test query", "Test Course", None)),
+            ({"lesson_number": 1}, ("test query", None, 1)),
+        ],
+        ids=["no_filter", "course", "lesson"],
+    )
+    def test_execute_forwards_filters(self, fake_vector_store, kwargs, expected_call):
+        """Test execute() formats results and forwards filters to the store"""
+        tool = CourseSearchTool(fake_vector_store)
+
+        result = tool.execute(query="test query", **kwargs)
+
+        # Should return formatted string with the document content
         assert isinstance(result, str)
-        assert len(result) > 0
-        # Should contain the document content
         assert "introduction to testing" in result.lower()
-        # Should have been called with correct parameters
-        mock_vector_store.search.assert_called_once_with(
-            query="test query", course_name=None, lesson_number=None
-        )
-
-    def test_execute_with_course_filter(self, mock_vector_store, sample_search_results):
-        """Test execute() with course_name filter"""
-        tool = CourseSearchTool(mock_vector_store)
-        mock_vector_store.search.return_value = sample_search_results
-
-        result = tool.execute(query="test query", course_name="Test Course")
-
-        mock_vector_store.search.assert_called_once_with(
-            query="test query", course_name="Test Course", lesson_number=None
-        )
-
-    def test_execute_with_lesson_filter(self, mock_vector_store, sample_search_results):
-        """Test execute() with lesson_number filter"""
-        tool = CourseSearchTool(mock_vector_store)
-        mock_vector_store.search.return_value = sample_search_results
-
-        result = tool.execute(query="test query", lesson_number=1)
-
-        mock_vector_store.search.assert_called_once_with(
-            query="test query", course_name=None, lesson_number=1
-        )
+        assert fake_vector_store.search_calls == [expected_call]
 
     def test_execute_handles_empty_results(
-        self, mock_vector_store, empty_search_results
+        self, fake_vector_store, empty_search_results
     ):
         """Test execute() handles empty results gracefully"""
-        tool = CourseSearchTool(mock_vector_store)
-        mock_vector_store.search.return_value = empty_search_results
+        fake_vector_store.search_results = empty_search_results
+        tool = CourseSearchTool(fake_vector_store)
 
         result = tool.execute(query="nonexistent query")
 
-        assert "No relevant content found" in result
+        assert result == "No relevant content found."
 
     def test_execute_handles_empty_results_with_filters(
-        self, mock_vector_store, empty_search_results
+        self, fake_vector_store, empty_search_results
     ):
         """Test execute() includes filter info in empty results message"""
-        tool = CourseSearchTool(mock_vector_store)
-        mock_vector_store.search.return_value = empty_search_results
+        fake_vector_store.search_results = empty_search_results
+        tool = CourseSearchTool(fake_vector_store)
 
         result = tool.execute(
             query="test", course_name="Nonexistent Course", lesson_number=99
         )
 
-        assert "No relevant content found" in result
-        assert "Nonexistent Course" in result
-        assert "lesson 99" in result
+        _assert_contains_all(
+            result, "No relevant content found", "Nonexistent Course", "lesson 99"
+        )
 
     def test_execute_handles_error_results(
-        self, mock_vector_store, error_search_results
+        self, fake_vector_store, error_search_results
     ):
         """Test execute() returns error message when search fails"""
-        tool = CourseSearchTool(mock_vector_store)
-        mock_vector_store.search.return_value = error_search_results
+        fake_vector_store.search_results = error_search_results
+        tool = CourseSearchTool(fake_vector_store)
 
         result = tool.execute(query="test query")
 
@@ -101,105 +139,116 @@ class TestCourseSearchTool:
         assert "Search failed" in result
 
     def test_format_results_creates_source_links(
-        self, mock_vector_store, sample_search_results
+        self, search_tool, sample_search_results
     ):
         """Test that _format_results() creates SourceLink objects"""
-        tool = CourseSearchTool(mock_vector_store)
-        mock_vector_store.get_lesson_link.return_value = "https://example.com/lesson-0"
-
-        formatted = tool._format_results(sample_search_results)
+        formatted, sources = search_tool._format_results(sample_search_results)
 
-        # Check that last_sources was populated
-        assert len(tool.last_sources) == 2
-        assert all(isinstance(source, SourceLink) for source in tool.last_sources)
+        # Check that the sources were returned with the text
+        assert len(sources) == 2
+        assert _all_source_links(sources)
 
         # Check SourceLink properties
-        first_source = tool.last_sources[0]
+        first_source = sources[0]
         assert first_source.text is not None
-        assert "Test Course" in first_source.text
+        assert "Test Course" in first_source.text, f"got {first_source.text!r}"
 
     def test_format_results_includes_lesson_links(
-        self, mock_vector_store, sample_search_results
+        self, search_tool, mock_vector_store, sample_search_results
     ):
         """Test that _format_results() includes lesson links when available"""
-        tool = CourseSearchTool(mock_vector_store)
-        lesson_link = "https://example.com/lesson-0"
-        mock_vector_store.get_lesson_link.return_value = lesson_link
-
-        formatted = tool._format_results(sample_search_results)
-
-        # Check that lesson links were fetched
-        assert mock_vector_store.get_lesson_link.called
+        formatted, sources = search_tool._format_results(sample_search_results)
+
+        # Check that lesson links were fetched in a single batched call
+        links_batch = mock_vector_store.get_lesson_links_batch
+        assert links_batch.call_count == 1
+        assert links_batch.call_args.args == (
+            [
+                ("Test Course: Introduction to Testing", 0),
+                ("Test Course: Introduction to Testing", 1),
+            ],
+        )
 
         # Check that source has the link
-        sources_with_links = [s for s in tool.last_sources if s.link is not None]
+        sources_with_links = [s for s in sources if s.link is not None]
         assert len(sources_with_links) > 0
 
-    def test_format_results_sorts_sources(self, mock_vector_store):
-        """Test that _format_results() sorts sources by course and lesson"""
-        # Create search results with mixed order
-        mixed_results = SearchResults(
-            documents=["doc1", "doc2", "doc3"],
-            metadata=[
-                {"course_title": "B Course", "lesson_number": 2},
-                {"course_title": "A Course", "lesson_number": 1},
-                {"course_title": "A Course", "lesson_number": 0},
-            ],
-            distances=[0.1, 0.2, 0.3],
+    def test_run_sorts_sources_and_keeps_result_order(self, fake_vector_store):
+        """Test that sources are sorted while the text keeps search order"""
+        fake_vector_store.search_results = SearchResults(
+            documents=["doc1", "doc2", "doc3", "doc4"],
+            metadata=MIXED_METADATA,
+            distances=[0.1, 0.2, 0.3, 0.4],
         )
-
-        tool = CourseSearchTool(mock_vector_store)
-        mock_vector_store.get_lesson_link.return_value = None
-
-        formatted = tool._format_results(mixed_results)
-
-        # Sources should be sorted: A Course L0, A Course L1, B Course L2
-        assert len(tool.last_sources) == 3
-        assert "A Course" in tool.last_sources[0].text
-        assert "Lesson 0" in tool.last_sources[0].text
-        assert "A Course" in tool.last_sources[1].text
-        assert "Lesson 1" in tool.last_sources[1].text
-        assert "B Course" in tool.last_sources[2].text
-
-
+        tool = CourseSearchTool(fake_vector_store)
+
+        formatted, sources = tool.run(query="test query")
+
+        # Sources: by course, then lesson, lesson-less last in its course
+        assert [source.text for source in sources] == [
+            "A Course - Lesson 0",
+            "A Course - Lesson 1",
+            "A Course",
+            "B Course - Lesson 2",
+        ], sources
+        # Text: most relevant chunk first, exactly as the store ranked them
+        assert formatted.split("\n\n") == [
+            "[B Course - Lesson 2]\ndoc1",
+            "[A Course]\ndoc2",
+            "[A Course - Lesson 1]\ndoc3",
+            "[A Course - Lesson 0]\ndoc4",
+        ], formatted
+
+    def test_source_sort_key_orders_by_course_then_lesson(self):
+        """Test that sources sort by course, then lesson, lesson-less last"""
+        ordered = sorted(MIXED_METADATA, key=_source_sort_key)
+
+        assert ordered == [
+            {"course_title": "A Course", "lesson_number": 0},
+            {"course_title": "A Course", "lesson_number": 1},
+            {"course_title": "A Course"},
+            {"course_title": "B Course", "lesson_number": 2},
+        ], ordered
+
+
+@pytest.mark.unit
+@pytest.mark.xdist_group("outline_tool")
 class TestCourseOutlineTool:
     """Tests for CourseOutlineTool"""
 
-    def test_get_tool_definition(self, mock_vector_store):
+    def test_get_tool_definition(self, outline_tool):
         """Test that tool definition is correctly structured"""
-        tool = CourseOutlineTool(mock_vector_store)
-        definition = tool.get_tool_definition()
+        definition = outline_tool.get_tool_definition()
 
+        assert outline_tool.get_tool_definition() is definition
         assert definition["name"] == "get_course_outline"
         assert "description" in definition
         assert "course_name" in definition["input_schema"]["properties"]
         assert "course_name" in definition["input_schema"]["required"]
 
-    def test_execute_returns_outline(self, mock_vector_store):
+    def test_execute_returns_outline(self, outline_tool, mock_vector_store):
         """Test execute() returns formatted course outline"""
-        tool = CourseOutlineTool(mock_vector_store)
 
-        result = tool.execute(course_name="Test Course")
+        result = outline_tool.execute(course_name="Test Course")
 
         assert isinstance(result, str)
         assert "Test Course" in result
         assert "Lesson" in result
-        mock_vector_store.get_course_outline.assert_called_once_with("Test Course")
+        get_outline = mock_vector_store.get_course_outline
+        assert get_outline.call_count == 1
+        assert get_outline.call_args.args == ("Test Course",)
 
-    def test_execute_handles_course_not_found(self, mock_vector_store):
+    def test_execute_handles_course_not_found(self, outline_tool, mock_vector_store):
         """Test execute() handles course not found gracefully"""
-        tool = CourseOutlineTool(mock_vector_store)
         mock_vector_store.get_course_outline.return_value = None
 
-        result = tool.execute(course_name="Nonexistent Course")
+        result = outline_tool.execute(course_name="Nonexistent Course")
 
         assert "No course found" in result
         assert "Nonexistent Course" in result
 
-    def test_format_outline_includes_all_info(self, mock_vector_store, sample_course):
+    def test_format_outline_includes_all_info(self, outline_tool, sample_course):
         """Test that _format_outline() includes all course information"""
-        tool = CourseOutlineTool(mock_vector_store)
-
         outline_data = {
             "title": sample_course.title,
             "course_link": sample_course.course_link,
@@ -211,99 +260,155 @@ class TestCourseOutlineTool:
             "lesson_count": len(sample_course.lessons),
         }
 
-        formatted = tool._format_outline(outline_data)
+        formatted = outline_tool._format_outline(outline_data)
 
-        assert sample_course.title in formatted
-        assert sample_course.course_link in formatted
-        assert sample_course.instructor in formatted
-        assert "3 total" in formatted  # 3 lessons
-        assert "Getting Started with Tests" in formatted
+        _assert_contains_all(
+            formatted,
+            sample_course.title,
+            sample_course.course_link,
+            sample_course.instructor,
+            "3 total",  # 3 lessons
+            "Getting Started with Tests",
+        )
 
 
+@pytest.mark.unit
+@pytest.mark.xdist_group("tool_manager")
 class TestToolManager:
     """Tests for ToolManager"""
 
-    def test_register_tool(self, mock_vector_store):
-        """Test that tools can be registered"""
-        manager = ToolManager()
-        tool = CourseSearchTool(mock_vector_store)
-
-        manager.register_tool(tool)
-
-        assert "search_course_content" in manager.tools
-
-    def test_register_multiple_tools(self, mock_vector_store):
-        """Test that multiple tools can be registered"""
+    @pytest.mark.parametrize(
+        "registered_manager,expected_names",
+        [
+            (("search",), ["search_course_content"]),
+            (
+                ("search", "outline"),
+                ["search_course_content", "get_course_outline"],
+            ),
+        ],
+        ids=["search", "search_and_outline"],
+        indirect=["registered_manager"],
+    )
+    def test_register_tools(self, registered_manager, expected_names):
+        """Test that registered tools and their definitions are exposed by name"""
+        definitions = registered_manager.get_tool_definitions()
+
+        assert list(registered_manager.tools) == expected_names
+        assert [d["name"] for d in definitions] == expected_names
+
+    def test_get_tool_definitions_cached_until_register(
+        self, search_tool, outline_tool
+    ):
+        """Test that definitions are reused and rebuilt after registration"""
         manager = ToolManager()
-        search_tool = CourseSearchTool(mock_vector_store)
-        outline_tool = CourseOutlineTool(mock_vector_store)
-
         manager.register_tool(search_tool)
-        manager.register_tool(outline_tool)
-
-        assert len(manager.tools) == 2
-        assert "search_course_content" in manager.tools
-        assert "get_course_outline" in manager.tools
 
-    def test_get_tool_definitions(self, mock_vector_store):
-        """Test that tool definitions can be retrieved"""
-        manager = ToolManager()
-        tool = CourseSearchTool(mock_vector_store)
-        manager.register_tool(tool)
+        first = manager.get_tool_definitions()
+        assert manager.get_tool_definitions() is first
 
-        definitions = manager.get_tool_definitions()
+        manager.register_tool(outline_tool)
+        second = manager.get_tool_definitions()
 
-        assert len(definitions) == 1
-        assert definitions[0]["name"] == "search_course_content"
+        assert second is not first
+        assert [d["name"] for d in second] == [
+            "search_course_content",
+            "get_course_outline",
+        ]
 
-    def test_execute_tool(self, mock_vector_store, sample_search_results):
+    def test_execute_tool(self, search_tool, mock_vector_store, sample_search_results):
         """Test that tools can be executed by name"""
         manager = ToolManager()
-        tool = CourseSearchTool(mock_vector_store)
-        manager.register_tool(tool)
+        manager.register_tool(search_tool)
 
         mock_vector_store.search.return_value = sample_search_results
-        result = manager.execute_tool("search_course_content", query="test")
+        result, sources = manager.execute_tool("search_course_content", query="test")
 
         assert isinstance(result, str)
         assert len(result) > 0
+        assert len(sources) == 2
+        assert _all_source_links(sources)
 
-    def test_execute_tool_not_found(self, mock_vector_store):
+    def test_execute_tool_not_found(self):
         """Test that executing nonexistent tool returns error"""
         manager = ToolManager()
 
-        result = manager.execute_tool("nonexistent_tool", query="test")
+        result, sources = manager.execute_tool("nonexistent_tool", query="test")
 
         assert "not found" in result.lower()
+        assert sources == []
 
-    def test_get_last_sources(self, mock_vector_store, sample_search_results):
-        """Test that last sources can be retrieved"""
+    def test_execute_tool_sources_belong_to_each_call(
+        self, search_tool, outline_tool, mock_vector_store, sample_search_results
+    ):
+        """Test that each call returns its own sources and none are kept"""
         manager = ToolManager()
-        tool = CourseSearchTool(mock_vector_store)
-        manager.register_tool(tool)
+        manager.register_tool(search_tool)
+        manager.register_tool(outline_tool)
 
-        # Execute search to populate sources
         mock_vector_store.search.return_value = sample_search_results
-        manager.execute_tool("search_course_content", query="test")
-
-        sources = manager.get_last_sources()
+        _, search_sources = manager.execute_tool("search_course_content", query="a")
+        _, outline_sources = manager.execute_tool(
+            "get_course_outline", course_name="Test"
+        )
 
-        assert isinstance(sources, list)
-        assert len(sources) > 0
-        assert all(isinstance(s, SourceLink) for s in sources)
+        assert len(search_sources) == 2
+        assert outline_sources == []
 
-    def test_reset_sources(self, mock_vector_store, sample_search_results):
-        """Test that sources can be reset"""
+    def test_execute_tool_reuses_cached_result(
+        self, search_tool, mock_vector_store, sample_search_results
+    ):
+        """Test that repeated identical calls are served from the tool cache"""
         manager = ToolManager()
-        tool = CourseSearchTool(mock_vector_store)
-        manager.register_tool(tool)
+        manager.register_tool(search_tool)
 
-        # Execute search to populate sources
         mock_vector_store.search.return_value = sample_search_results
-        manager.execute_tool("search_course_content", query="test")
+        first = manager.execute_tool("search_course_content", query="test")
+        second = manager.execute_tool("search_course_content", query="test")
+
+        assert first == second
+        assert mock_vector_store.search.call_count == 1
+        # A cache hit returns a copy of the cached sources
+        assert len(second[1]) == 2
+        assert second[1] is not first[1]
+
+    def test_execute_tool_cache_evicts_expired_then_least_recent(
+        self, outline_tool, mock_vector_store
+    ):
+        """Test that the tool cache is bounded and drops expired entries first"""
+        manager = ToolManager()
+        manager.register_tool(outline_tool)
+
+        with (
+            patch("search_tools.TOOL_CACHE_SIZE", 2),
+            patch("search_tools.time.monotonic") as clock,
+        ):
+            clock.return_value = 0.0
+            manager.execute_tool("get_course_outline", course_name="A")
+            clock.return_value = outline_tool.cache_ttl
+            manager.execute_tool("get_course_outline", course_name="B")
+            manager.execute_tool("get_course_outline", course_name="C")
+            # A expired, so it goes instead of the least recently used B
+            assert [key[1][0][1] for key in manager._cache] == ["B", "C"]
+
+            manager.execute_tool("get_course_outline", course_name="B")
+            manager.execute_tool("get_course_outline", course_name="D")
+            # B was just reused, so the least recently used C is evicted
+            assert [key[1][0][1] for key in manager._cache] == ["B", "D"]
+
+        assert mock_vector_store.get_course_outline.call_count == 4
+
+    def test_execute_tool_cache_respects_ttl_and_clear(
+        self, outline_tool, mock_vector_store
+    ):
+        """Test that expired or cleared entries are re-executed"""
+        manager = ToolManager()
+        manager.register_tool(outline_tool)
+
+        manager.execute_tool("get_course_outline", course_name="Test")
+        manager.clear_cache()
+        manager.execute_tool("get_course_outline", course_name="Test")
 
-        # Reset sources
-        manager.reset_sources()
+        with patch.object(CourseOutlineTool, "cache_ttl", 0):
+            manager.execute_tool("get_course_outline", course_name="Test")
 
-        sources = manager.get_last_sources()
-        assert len(sources) == 0
+        assert mock_vector_store.get_course_outline.call_count == 3
@@ -1,12 +1,13 @@
 from dataclasses import dataclass
-from typing import Any, Dict, List, Optional
+from typing import Any, Dict, List, Optional, Tuple
 
 import chromadb
+import orjson
 from chromadb.config import Settings
 from models import Course, CourseChunk
 
 
-@dataclass
+@dataclass(slots=True)
 class SearchResults:
     """Container for search results with metadata"""
 
@@ -148,8 +149,6 @@ class VectorStore:
 
     def add_course_metadata(self, course: Course):
         """Add course information to the catalog for semantic search"""
-        import json
-
         course_text = course.title
 
         # Build lessons metadata and serialize as JSON string
@@ -170,9 +169,9 @@ class VectorStore:
                     "title": course.title,
                     "instructor": course.instructor,
                     "course_link": course.course_link,
-                    "lessons_json": json.dumps(
+                    "lessons_json": orjson.dumps(
                         lessons_metadata
-                    ),  # Serialize as JSON string
+                    ).decode(),  # Serialize as JSON string
                     "lesson_count": len(course.lessons),
                 }
             ],
@@ -237,8 +236,6 @@ class VectorStore:
 
     def get_all_courses_metadata(self) -> List[Dict[str, Any]]:
         """Get metadata for all courses in the vector store"""
-        import json
-
         try:
             results = self.course_catalog.get()
             if results and "metadatas" in results:
@@ -247,7 +244,9 @@ class VectorStore:
                 for metadata in results["metadatas"]:
                     course_meta = metadata.copy()
                     if "lessons_json" in course_meta:
-                        course_meta["lessons"] = json.loads(course_meta["lessons_json"])
+                        course_meta["lessons"] = orjson.loads(
+                            course_meta["lessons_json"]
+                        )
                         del course_meta[
                             "lessons_json"
                         ]  # Remove the JSON string version
@@ -273,8 +272,6 @@ class VectorStore:
 
     def get_lesson_link(self, course_title: str, lesson_number: int) -> Optional[str]:
         """Get lesson link for a given course title and lesson number"""
-        import json
-
         try:
             # Get course by ID (title is the ID)
             results = self.course_catalog.get(ids=[course_title])
@@ -282,7 +279,7 @@ class VectorStore:
                 metadata = results["metadatas"][0]
                 lessons_json = metadata.get("lessons_json")
                 if lessons_json:
-                    lessons = json.loads(lessons_json)
+                    lessons = orjson.loads(lessons_json)
                     # Find the lesson with matching number
                     for lesson in lessons:
                         if lesson.get("lesson_number") == lesson_number:
@@ -291,6 +288,33 @@ class VectorStore:
         except Exception as e:
             print(f"Error getting lesson link: {e}")
 
+    def get_lesson_links_batch(
+        self, pairs: List[Tuple[str, int]]
+    ) -> Dict[Tuple[str, int], Optional[str]]:
+        """Get lesson links for many (course title, lesson number) pairs at once"""
+        links: Dict[Tuple[str, int], Optional[str]] = {pair: None for pair in pairs}
+        if not links:
+            return links
+
+        try:
+            # One catalog lookup covers every course referenced by the pairs
+            course_titles = list(dict.fromkeys(title for title, _ in links))
+            results = self.course_catalog.get(ids=course_titles)
+            if results and "metadatas" in results and results["metadatas"]:
+                for metadata in results["metadatas"]:
+                    lessons_json = metadata.get("lessons_json")
+                    if not lessons_json:
+                        continue
+                    title = metadata.get("title")
+                    for lesson in orjson.loads(lessons_json):
+                        key = (title, lesson.get("lesson_number"))
+                        if key in links:
+                            links[key] = lesson.get("lesson_link")
+        except Exception as e:
+            print(f"Error getting lesson links: {e}")
+
+        return links
+
     def get_course_outline(self, course_name: str) -> Optional[Dict[str, Any]]:
         """
         Get complete outline for a specific course including all lessons.
@@ -301,8 +325,6 @@ class VectorStore:
         Returns:
             Dict with title, course_link, instructor, lessons list, or None if not found
         """
-        import json
-
         try:
             # Resolve fuzzy course name to exact title
             course_title = self._resolve_course_name(course_name)
@@ -316,7 +338,7 @@ class VectorStore:
                 # Parse lessons from JSON
                 lessons = []
                 if "lessons_json" in metadata:
-                    lessons = json.loads(metadata["lessons_json"])
+                    lessons = orjson.loads(metadata["lessons_json"])
 
                 return {
                     "title": metadata.get("title"),
@@ -0,0 +1,12 @@
+#!/bin/bash
+
+# Run the full test suite, slow tests included, in parallel across all CPU cores
+echo "Running pytest with xdist..."
+PYTHONDONTWRITEBYTECODE=1 uv run pytest -n auto --dist=loadgroup --full-api -m ""
+
+if [ $? -eq 0 ]; then
+    echo "✅ Tests passed!"
+else
+    echo "❌ Tests failed. Please fix the issues above."
+    exit 1
+fi